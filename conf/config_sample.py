@@ -50,6 +50,11 @@ LOGLEVEL = 'DEBUG'
 LOG_ROTATION = True
 LOG_SIZE = 10485760  # Rotate every 10M
 LOG_RETENTION = 10  # Keep 10 Logs
+
+# Write logs from a background thread, records over the queue size are dropped (and counted)
+LOG_ASYNC = False
+LOG_ASYNC_QUEUE_SIZE = 10000
+
 # How many threads use for synchronous methods (services).
 # 30 is enough for small installation, for real usage
 # it should be slightly more, say 100-300.
@@ -92,6 +97,11 @@ DB_MYSQL_PASS = '123456'
 DB_LOADER_CHECKTIME = 15  # How often we check to see if we should run the loader
 DB_LOADER_REC_MIN = 10  # Min Records before the bulk loader fires
 DB_LOADER_REC_MAX = 50  # Max Records the bulk loader will commit at a time
+DB_LOADER_CHUNK_SIZE = 500  # Max Records sent in one multi-row INSERT statement
+
+DB_POOL_SIZE = 5  # Max open DB connections (shared by the pool and the loader threads)
+DB_POOL_MAX_IDLE = 300  # Close DB connections unused for this many seconds
+DB_WORKER_DIFF_FLUSH_TIME = 5  # How often buffered worker difficulties are written to the DB
 
 DB_LOADER_FORCE_TIME = 300  # How often the cache should be flushed into the DB regardless of size.
 
@@ -118,8 +128,28 @@ MERKLE_REFRESH_INTERVAL = 60  # How often check memorypool
 #	This effectively resets the template and incorporates new transactions.
 #	This should be "slow"
 
+# New blocks are pushed by a getblocktemplate long poll when Dashcoind supports it,
+# prevhash polling is then relaxed to LONGPOLL_PREVHASH_REFRESH_INTERVAL
+LONGPOLL_ENABLED = True
+LONGPOLL_PREVHASH_REFRESH_INTERVAL = 30
+
 INSTANCE_ID = 31  # Used for extranonce and needs to be 0-31
 
+# Duplicate share detection
+SUBMITS_SPLIT_BY_EXTRANONCE1 = False  # Group submitted shares of a job per connection
+SUBMITS_MAX_PER_JOB = 0  # Max registered shares per job (more are rejected as "Too many shares"), 0 = no limit
+
+# Share validation in worker processes
+SHARE_WORKER_PROCESSES = 0  # Processes hashing shares, 0 = hash in the main process
+SHARE_WORKER_QUEUE_MAX = 1000  # Pause submitting connections above this many queued shares
+SHARE_WORKER_TIMEOUT = 10  # Reject shares not hashed in this many seconds (e.g. a worker died)
+SHARE_WORKER_THREADS = 0  # Threads hashing shares when there are no worker processes
+SHARE_BATCH_WINDOW = 0  # Send shares submitted within this many seconds to the workers as one task, 0 = no batching
+SHARE_BATCH_MAX = 100  # Max shares per batch
+
+# Send new jobs to this many connections per reactor iteration, 0 = all at once
+NOTIFY_BROADCAST_CHUNK = 0
+
 # ******************** Pool Difficulty Settings *********************
 #  Again, Don't change unless you know what this is for.
 
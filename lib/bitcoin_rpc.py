@@ -4,62 +4,177 @@
 
 import simplejson as json
 import base64
-from twisted.internet import defer
-from twisted.web import client
+from StringIO import StringIO
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.web import client, error
+from twisted.web.http_headers import Headers
 import time, sys
 
+import settings
+
 import lib.logger
+from lib.exceptions import RPCError
 
 log = lib.logger.get_logger('bitcoin_rpc')
 
 
+def split_batch(d, count):
+    '''Turns Deferred of batch results into list of Deferreds,
+    one for each call of the batch. Failure of the whole request
+    is passed to all of them.'''
+    ds = [defer.Deferred() for _ in xrange(count)]
+
+    def fire(results):
+        for (success, value), call_d in zip(results, ds):
+            if success:
+                call_d.callback(value)
+            else:
+                call_d.errback(value)
+
+    def fail(f):
+        for call_d in ds:
+            call_d.errback(f)
+
+    d.addCallbacks(fire, fail)
+    return ds
+
+
+class QuietHTTP11ClientFactory(client._HTTP11ClientFactory):
+    noisy = False
+
+
+class QuietHTTPConnectionPool(client.HTTPConnectionPool):
+    # Connections are opened often, "Starting factory" lines only add noise
+    _factory = QuietHTTP11ClientFactory
+
+
 class BitcoinRPC(object):
 
     def __init__(self, host, port, username, password):
         self.bitcoin_url = 'http://%s:%d' % (host, port)
         self.credentials = base64.b64encode("%s:%s" % (username, password))
-        self.headers = {
-            'Content-Type': 'text/json',
-            'Authorization': 'Basic %s' % self.credentials,
-        }
-        client.HTTPClientFactory.noisy = False
-
-    def _call_raw(self, data):
-        client.Headers
-        return client.getPage(
-            url=self.bitcoin_url,
-            method='POST',
-            headers=self.headers,
-            postdata=data,
-        )
-
-    def _call(self, method, params):
+        self.headers = Headers({
+            'Content-Type': ['text/json'],
+            'Authorization': ['Basic %s' % self.credentials],
+        })
+
+        # Persistent (keep-alive) connections to the daemon
+        self.pool = QuietHTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = settings.RPC_MAX_PERSISTENT
+        self.pool.cachedConnectionTimeout = settings.RPC_KEEPALIVE_TIMEOUT
+        reactor.addSystemEventTrigger('before', 'shutdown', self.pool.closeCachedConnections)
+        self.agent = client.Agent(reactor, connectTimeout=settings.RPC_CONNECT_TIMEOUT, pool=self.pool)
+
+        # Limit of requests waiting for the daemon at once
+        self.in_flight = defer.DeferredSemaphore(settings.RPC_MAX_IN_FLIGHT)
+
+    def _call_raw(self, data, timeout=None, queued=True):
+        # Found blocks and long polls (held by Dashcoind for minutes)
+        # do not take a slot of the in-flight limit
+        if queued:
+            d = self.in_flight.run(self._request, data)
+        else:
+            d = self._request(data)
+
+        # Time spent in the in-flight queue counts too,
+        # cancelling a queued call gives up its place in the queue
+        timeout = timeout or settings.RPC_TIMEOUT
+        timeout_call = reactor.callLater(timeout, d.cancel)
+        d.addBoth(self._request_done, timeout_call, timeout)
+        return d
+
+    def _request(self, data):
+        d = self.agent.request('POST', self.bitcoin_url, self.headers, client.FileBodyProducer(StringIO(data)))
+        d.addCallback(self._read_response)
+        return d
+
+    def _read_response(self, response):
+        d = client.readBody(response)
+        if response.code != 200:
+            # Same error as raised by getPage, callers read the body from e[2]
+            d.addCallback(lambda body: defer.fail(error.Error(str(response.code), response.phrase, body)))
+        return d
+
+    def _request_done(self, result, timeout_call, timeout):
+        if timeout_call.active():
+            timeout_call.cancel()
+        elif isinstance(result, failure.Failure):
+            # The request has been cancelled by the timeout
+            raise defer.TimeoutError("Dashcoind did not respond in %s sec" % timeout)
+        return result
+
+    def _call(self, method, params, timeout=None, queued=True):
         return self._call_raw(json.dumps({
             'jsonrpc': '2.0',
             'method': method,
             'params': params,
             'id': '1',
-        }))
+        }), timeout, queued)
+
+    def _batch(self, calls, timeout=None, queued=True):
+        '''Sends list of (method, params) calls in one HTTP request.
+        Dashcoind runs them in the given order. Returns Deferred with
+        list of (success, result or RPCError), one for each call.'''
+        d = self._call_raw(json.dumps([{
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': i,
+        } for (i, (method, params)) in enumerate(calls)]), timeout, queued)
+        d.addCallback(self._parse_batch, calls)
+        return d
+
+    def _parse_batch(self, resp, calls):
+        results = [(False, RPCError("No response for %s" % method)) for (method, _) in calls]
+        for r in json.loads(resp):
+            if r.get('error'):
+                results[r['id']] = (False, RPCError(r['error']))
+            else:
+                results[r['id']] = (True, r['result'])
+        return results
+
+    def batch(self, calls, timeout=None):
+        '''Sends list of (method, params) calls in one HTTP request
+        and returns list of Deferreds with their results.'''
+        return split_batch(self._batch(calls, timeout), len(calls))
 
     @defer.inlineCallbacks
     def submitblock(self, block_hex, block_hash_hex):
         # Try submitblock if that fails, go to getblocktemplate
+        # getblock is sent in the same request, Dashcoind runs it after submitblock.
+        # Found blocks do not wait in the queue behind other calls.
         log.debug("submitblock %s" % block_hash_hex)
+        block = None
         try:
-            resp = (yield self._call('submitblock', [block_hex, ]))
-            log.debug("submit return: %s", resp)
+            (submitted, block) = (yield self._batch([('submitblock', [block_hex, ]), ('getblock', [block_hash_hex, ])],
+                                                    settings.RPC_SUBMITBLOCK_TIMEOUT, False))
+            if not submitted[0]:
+                raise submitted[1]
+            result = submitted[1]
+            log.debug("submit return: %s", result)
         except Exception as e:
             print >> sys.stderr, "Problem Submitting submitblock", str(e)
             log.exception("Problem Submitting block %s" % str(e))
+            block = None
             try:
-                resp = (yield self._call('getblocktemplate', [{'mode': 'submit', 'data': block_hex}]))
+                resp = (yield self._call('getblocktemplate', [{'mode': 'submit', 'data': block_hex}],
+                                         settings.RPC_SUBMITBLOCK_TIMEOUT, False))
             except Exception as e:
                 log.exception("Problem Submitting block %s" % str(e))
                 raise
+            result = json.loads(resp)['result']
 
-        if json.loads(resp)['result'] == None:
+        if result == None:
             # make sure the block was created. 
-            defer.returnValue((yield self.blockexists(block_hash_hex)))
+            if block is None:
+                defer.returnValue((yield self.blockexists(block_hash_hex)))
+            elif block[0] and block[1]['hash'] == block_hash_hex:
+                log.debug("Block Confirmed: %s" % block_hash_hex)
+                defer.returnValue(True)
+            else:
+                log.info("Cannot find block for %s" % block_hash_hex)
+                defer.returnValue(False)
         else:
             defer.returnValue(False)
 
@@ -73,6 +188,14 @@ class BitcoinRPC(object):
         resp = (yield self._call('getblocktemplate', [{}]))
         defer.returnValue(json.loads(resp)['result'])
 
+    @defer.inlineCallbacks
+    def getblocktemplate_longpoll(self, longpollid):
+        '''Dashcoind answers when the chain tip changes (or the mempool
+        changed and some time passed), raises TimeoutError otherwise.'''
+        resp = (yield self._call('getblocktemplate', [{'longpollid': longpollid}],
+                                 settings.RPC_LONGPOLL_TIMEOUT, False))
+        defer.returnValue(json.loads(resp)['result'])
+
     # @defer.inlineCallbacks
     # def prevhash(self):
     #     resp = (yield self._call('getwork', []))
@@ -5,6 +5,8 @@
 
 import simplejson as json
 from twisted.internet import defer
+from twisted.python import failure
+from twisted.web import error as web_error
 
 import settings
 
@@ -13,114 +15,176 @@ import time
 import lib.logger
 log = lib.logger.get_logger('bitcoin_rpc_manager')
 
-from lib.bitcoin_rpc import BitcoinRPC
+from lib.bitcoin_rpc import BitcoinRPC, split_batch
 
 
 class BitcoinRPCManager(object):
+    """Sends every call to the current Dashcoind and fails over to the
+    next healthy one when the call fails. A failed node is tried after
+    the healthy ones until its backoff expires, the backoff doubles with
+    every consecutive failure (RPC_BACKOFF_MIN up to RPC_BACKOFF_MAX).
+    When all nodes are backing off, the one ready first is tried at once."""
     
     def __init__(self):
         self.conns = {}
-        self.conns[0] = BitcoinRPC(settings.DASHCOIN_TRUSTED_HOST,
-                             settings.DASHCOIN_TRUSTED_PORT,
-                             settings.DASHCOIN_TRUSTED_USER,
-                             settings.DASHCOIN_TRUSTED_PASSWORD)
+        self.health = {}
+        self.add_connection(settings.DASHCOIN_TRUSTED_HOST,
+                            settings.DASHCOIN_TRUSTED_PORT,
+                            settings.DASHCOIN_TRUSTED_USER,
+                            settings.DASHCOIN_TRUSTED_PASSWORD)
         self.curr_conn = 0
+        # Network difficulty, refreshed together with every prevhash() poll
+        self.difficulty = None
+        self.difficulty_time = 0
         for x in range (1, 99):
             if hasattr(settings, 'DASHCOIN_TRUSTED_HOST_' + str(x)) and hasattr(settings, 'DASHCOIN_TRUSTED_PORT_' + str(x)) and hasattr(settings, 'DASHCOIN_TRUSTED_USER_' + str(x)) and hasattr(settings, 'DASHCOIN_TRUSTED_PASSWORD_' + str(x)):
-                self.conns[len(self.conns)] = BitcoinRPC(settings.__dict__['DASHCOIN_TRUSTED_HOST_' + str(x)],
-                                                        settings.__dict__['DASHCOIN_TRUSTED_PORT_' + str(x)],
-                                                        settings.__dict__['DASHCOIN_TRUSTED_USER_' + str(x)],
-                                                        settings.__dict__['DASHCOIN_TRUSTED_PASSWORD_' + str(x)])
+                self.add_connection(settings.__dict__['DASHCOIN_TRUSTED_HOST_' + str(x)],
+                                    settings.__dict__['DASHCOIN_TRUSTED_PORT_' + str(x)],
+                                    settings.__dict__['DASHCOIN_TRUSTED_USER_' + str(x)],
+                                    settings.__dict__['DASHCOIN_TRUSTED_PASSWORD_' + str(x)])
 
     def add_connection(self, host, port, user, password):
         # TODO: Some string sanity checks
-        self.conns[len(self.conns)] = BitcoinRPC(host, port, user, password)
-
-    def next_connection(self):
-        time.sleep(1)
-        if len(self.conns) <= 1:
-            log.error("Problem with Pool 0 -- NO ALTERNATE POOLS!!!")
-            time.sleep(4)
-            return
-        log.error("Problem with Pool %i Switching to Next!" % (self.curr_conn) )
-        self.curr_conn = self.curr_conn + 1
-        if self.curr_conn >= len(self.conns):
-            self.curr_conn = 0
+        i = len(self.conns)
+        self.conns[i] = BitcoinRPC(host, port, user, password)
+        self.health[i] = {'failures': 0, 'retry_at': 0}
+
+    def _mark_up(self, i):
+        if self.health[i]['failures']:
+            log.info("Pool %i is back" % i)
+        self.health[i]['failures'] = 0
+        self.health[i]['retry_at'] = 0
+
+    def _mark_down(self, i):
+        health = self.health[i]
+        health['failures'] += 1
+        backoff = min(settings.RPC_BACKOFF_MAX, settings.RPC_BACKOFF_MIN * 2 ** (health['failures'] - 1))
+        health['retry_at'] = time.time() + backoff
+        log.error("Problem with Pool %i, trying it last for %d sec" % (i, backoff))
+
+    def next_connection(self, tried=()):
+        """Returns index of the connection which should be tried next, None
+        when all were tried already. Healthy connections are preferred,
+        starting with the current one. When all connections are backing off,
+        the one which is ready first is returned."""
+        now = time.time()
+        candidates = [(self.curr_conn + x) % len(self.conns) for x in range(len(self.conns))]
+        candidates = [i for i in candidates if i not in tried]
+        if not candidates:
+            return None
+
+        for i in candidates:
+            if self.health[i]['retry_at'] <= now:
+                return i
+
+        return min(candidates, key=lambda i: self.health[i]['retry_at'])
 
     @defer.inlineCallbacks
-    def check_height(self):
+    def _failover(self, method, *args):
+        """Calls the method of the current connection. On failure the
+        call is repeated on the next connection, until every connection
+        was tried once. HTTP errors are answers of a running node and they
+        are passed to the caller directly."""
+        tried = set()
+        last_failure = None
+
         while True:
+            i = self.next_connection(tried)
+            if i is None:
+                last_failure.raiseException()
+            tried.add(i)
+
+            # Backoff only orders the connections, waiting for it would
+            # delay submitblock when there is a single Dashcoind
+            if self.health[i]['retry_at'] > time.time():
+                log.error("All pools are down, trying Pool %i anyway" % i)
+
             try:
-                resp = (yield self.conns[self.curr_conn]._call('getblockchaininfo', []))
-                break
-            except:
-                log.error("Check Height -- Pool %i Down!" % (self.curr_conn) )
-                self.next_connection()
-        curr_height = json.loads(resp)['result']['blocks']
-        log.debug("Check Height -- Current Pool %i : %i" % (self.curr_conn,curr_height) )
-        for i in self.conns:
-            if i == self.curr_conn:
+                result = yield getattr(self.conns[i], method)(*args)
+            except web_error.Error:
+                self._mark_up(i)
+                raise
+            except Exception:
+                last_failure = failure.Failure()
+                log.error("%s on Pool %i failed: %s" % (method, i, last_failure.getErrorMessage()))
+                self._mark_down(i)
                 continue
 
-            try:
-                    resp = (yield self.conns[i]._call('getinfo', []))
-            except:
+            self._mark_up(i)
+            if i != self.curr_conn:
+                log.error("Switching from Pool %i to Pool %i" % (self.curr_conn, i))
+                self.curr_conn = i
+            defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def check_height(self):
+        resp = yield self._failover('_call', 'getblockchaininfo', [])
+        curr_height = json.loads(resp)['result']['blocks']
+        log.debug("Check Height -- Current Pool %i : %i" % (self.curr_conn,curr_height) )
+        now = time.time()
+        others = [i for i in self.conns if i != self.curr_conn and self.health[i]['retry_at'] <= now]
+
+        # Ask all other pools at once
+        results = yield defer.DeferredList([self.conns[i]._call('getblockchaininfo', []) for i in others],
+                                           consumeErrors=True)
+        for i, (success, resp) in zip(others, results):
+            if not success:
                 log.error("Check Height -- Pool %i Down!" % (i,) )
+                self._mark_down(i)
                 continue
 
+            self._mark_up(i)
             height = json.loads(resp)['result']['blocks']
             log.debug("Check Height -- Pool %i : %i" % (i,height) )
             if height > curr_height:
                 self.curr_conn = i
         defer.returnValue(True)
 
+    def _check_height_failed(self, failure):
+        log.error("Check Height failed: %s" % failure.getErrorMessage())
+
     def _call_raw(self, data):
-        while True:
-            try:
-                return self.conns[self.curr_conn]._call_raw(data)
-            except:
-                self.next_connection()
+        return self._failover('_call_raw', data)
            
     def _call(self, method, params):
-        while True:
-            try:
-                return self.conns[self.curr_conn]._call(method,params)
-            except:
-                self.next_connection()
+        return self._failover('_call', method, params)
+
+    def batch(self, calls):
+        '''Sends list of (method, params) calls in one HTTP request
+        and returns list of Deferreds with their results.'''
+        return split_batch(self._failover('_batch', calls), len(calls))
 
     def submitblock(self, block_hex, block_hash_hex):
-        while True:
-            try:
-                return self.conns[self.curr_conn].submitblock(block_hex, block_hash_hex)
-            except:
-                self.next_connection()
+        return self._failover('submitblock', block_hex, block_hash_hex)
     
     def getblocktemplate(self):
-        while True:
-            try:
-                return self.conns[self.curr_conn].getblocktemplate()
-            except:
-                self.next_connection()
+        return self._failover('getblocktemplate')
+
+    def getblocktemplate_longpoll(self, longpollid):
+        # No failover, a long poll which times out is not a failure of
+        # the node. Ids of another node are harmless, Dashcoind answers
+        # at once when the id does not match its chain tip.
+        return self.conns[self.curr_conn].getblocktemplate_longpoll(longpollid)
  
     def prevhash(self):
-        self.check_height()
-        while True:
-            try:
-                return self.conns[self.curr_conn].prevhash()
-            except:
-                self.next_connection()
+        self.check_height().addErrback(self._check_height_failed)
+        # Difficulty goes first, so it is cached before callbacks of prevhash run
+        (difficulty, prevhash) = self.batch([('getdifficulty', []), ('getbestblockhash', [])])
+        difficulty.addCallbacks(self._update_difficulty, self._update_difficulty_failed)
+        return prevhash
+
+    def _update_difficulty(self, difficulty):
+        self.difficulty = difficulty
+        self.difficulty_time = time.time()
+
+    def _update_difficulty_failed(self, failure):
+        log.debug("getdifficulty failed: %s" % failure.getErrorMessage())
         
     def validateaddress(self, address):
-        while True:
-            try:
-                return self.conns[self.curr_conn].validateaddress(address)
-            except:
-                self.next_connection()
-        
+        return self._failover('validateaddress', address)
 
     def getdifficulty(self):
-        while True:
-            try:
-                return self.conns[self.curr_conn].getdifficulty()
-            except:
-                self.next_connection()
+        # Use the difficulty received with the last prevhash() poll if it is recent
+        if self.difficulty is not None and time.time() - self.difficulty_time < settings.MERKLE_REFRESH_INTERVAL:
+            return defer.succeed(self.difficulty)
+        return self._failover('getdifficulty')
@@ -1,12 +1,16 @@
-import StringIO
 import binascii
+import hashlib
 import struct
+import simplejson as json
 
 import util
 import merkletree
 import halfnode
 from coinbasetx import CoinbaseTransaction
+from submit_set import SubmitSet
+from transaction_cache import TransactionCache
 import lib
+from lib.logger import debug_enabled
 # Remove dependency to settings, coinbase extras should be
 # provided from coinbaser
 import settings
@@ -38,21 +42,34 @@ class BlockTemplate(halfnode.CBlock):
         
         # self.coinbase_hex = None
         self.merkletree = None
+        self.txs_serialized = ''  # All transactions except coinbase
 
         self.broadcast_args = []
+        self.notify_frames = {}
 
-        # List of 4-tuples (extranonce1, extranonce2, ntime, nonce)
+        # Set of (extranonce1, extranonce2, ntime, nonce) keys,
         # registers already submitted and checked shares
         # There may be registered also invalid shares inside!
-        self.submits = []
+        self.submits = SubmitSet(settings.SUBMITS_SPLIT_BY_EXTRANONCE1, settings.SUBMITS_MAX_PER_JOB)
 
-    def fill_from_rpc(self, data):
-        """Convert getblocktemplate result into BlockTemplate instance"""
+        # extranonce1 -> sha256 state after hashing coinb1 + extranonce1,
+        # these are constant for one connection on this job
+        self.coinbase_midstates = {}
+
+    def fill_from_rpc(self, data, tx_cache=None):
+        """Convert getblocktemplate result into BlockTemplate instance.
+        Transactions already known to tx_cache are not parsed again."""
+
+        if tx_cache is None:
+            tx_cache = TransactionCache()
+        txes = tx_cache.update(data['previousblockhash'], data['transactions'])
 
         # txhashes = [None] + [ binascii.unhexlify(t['hash']) for t in data['transactions'] ]
-        txhashes = [None] + [util.ser_uint256(int(t['hash'], 16)) for t in data['transactions']]
-        log.debug("txhashes: %s", "|".join([t['hash'] for t in data['transactions']]))
-        mt = merkletree.MerkleTree(txhashes)
+        txhashes = [None] + [txhash for (txhash, _) in txes]
+        if debug_enabled(log):
+            log.debug("txhashes: %s", "|".join([t['hash'] for t in data['transactions']]))
+        mt = merkletree.MerkleTree(txhashes, previous=tx_cache.merkletree)
+        tx_cache.merkletree = mt
 
         coinbase = self.coinbase_transaction_class(self.timestamper, self.coinbaser, data['coinbasevalue'],
                                                    data['coinbaseaux']['flags'], data['height'],
@@ -72,10 +89,9 @@ class BlockTemplate(halfnode.CBlock):
         self.nNonce = 0
         self.vtx = [coinbase, ]
 
-        for tx in data['transactions']:
-            t = halfnode.CTransaction()
-            t.deserialize(StringIO.StringIO(binascii.unhexlify(tx['data'])))
+        for (_, t) in txes:
             self.vtx.append(t)
+        self.txs_serialized = ''.join([t.serialize() for t in self.vtx[1:]])
 
         self.curtime = data['curtime']
         self.timedelta = self.curtime - int(self.timestamper.time())
@@ -85,19 +101,32 @@ class BlockTemplate(halfnode.CBlock):
         # Reversed prevhash
         self.prevhash_bin = binascii.unhexlify(util.reverse_hash(data['previousblockhash']))
         self.prevhash_hex = "%064x" % self.hashPrevBlock
+
+        # Constant parts of the header with every word swapped (as hashed)
+        self.header_prefix_swapped = struct.pack("<i", self.nVersion) + util.ser_uint256(self.hashPrevBlock)
+        self.nbits_swapped = struct.pack("<I", self.nBits)
         log.debug("fill_from_rpc previousblockhash: %s", self.prevhash_hex)
 
         self.broadcast_args = self.build_broadcast_args()
+        self.notify_frames = self.build_notify_frames(self.broadcast_args)
 
     def register_submit(self, extranonce1, extranonce2, ntime, nonce):
         """Client submitted some solution. Let's register it to
         prevent double submissions."""
 
-        t = (extranonce1, extranonce2, ntime, nonce)
-        if t not in self.submits:
-            self.submits.append(t)
-            return True
-        return False
+        return self.submits.add(extranonce1, extranonce2, ntime, nonce)
+
+    def check_submits_limit(self):
+        """Returns False (and counts the rejected share) when
+        the job holds SUBMITS_MAX_PER_JOB shares already."""
+        if self.submits.is_full():
+            self.submits.reject_full()
+            return False
+        return True
+
+    def get_submits_count(self):
+        """Number of share keys registered for this job"""
+        return len(self.submits)
 
     def build_broadcast_args(self):
         """Build parameters of mining.notify call. All clients
@@ -115,16 +144,35 @@ class BlockTemplate(halfnode.CBlock):
 
         return (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
 
-    def serialize_coinbase(self, extranonce1, extranonce2):
-        """Serialize coinbase with given extranonce1 and extranonce2
-        in binary form"""
+    def build_notify_frames(self, broadcast_args):
+        """Encode mining.notify line for both values of clean_jobs.
+        Notifications have no id, so the same bytes can be written
+        to every connection."""
+        params = list(broadcast_args[:-1])
+        frames = {}
+        for clean_jobs in (True, False):
+            frames[clean_jobs] = json.dumps({'id': None, 'method': 'mining.notify',
+                                             'params': params + [clean_jobs]}) + "\n"
+        return frames
+
+    def coinbase_hash(self, extranonce1, extranonce2):
+        """Double SHA-256 of coinbase with given extranonce1 and extranonce2
+        (both binary). The first round continues from the cached state
+        of coinb1 + extranonce1, so only the tail is hashed per share."""
         (part1, part2) = self.vtx[0]._serialized
-        return part1 + extranonce1 + extranonce2 + part2
+        state = self.coinbase_midstates.get(extranonce1)
+        if state is None:
+            state = self.coinbase_midstates[extranonce1] = hashlib.sha256(part1 + extranonce1)
+
+        h = state.copy()
+        h.update(extranonce2 + part2)
+        return hashlib.sha256(h.digest()).digest()
 
     def check_ntime(self, ntime):
         """Check for ntime restrictions."""
-        log.debug("check_ntime, ntime %d, curtime %d, timestamper %d", int(ntime), int(self.curtime),
-                  int(self.timestamper.time()))
+        if debug_enabled(log):
+            log.debug("check_ntime, ntime %d, curtime %d, timestamper %d", int(ntime), int(self.curtime),
+                      int(self.timestamper.time()))
 
         if ntime < self.curtime:
             return False
@@ -136,22 +184,23 @@ class BlockTemplate(halfnode.CBlock):
 
         return True
 
-    def serialize_header(self, merkle_root_int, ntime_bin, nonce_bin):
-        """Serialize header for calculating block hash"""
-        log.debug("serialize_header")
-        log.debug("pack nVersion %s", struct.pack(">i", self.nVersion).encode("hex"))
-        r = struct.pack(">i", self.nVersion)
-        log.debug("pack prevhash_bin %s", self.prevhash_bin.encode("hex"))
-        r += self.prevhash_bin
-        log.debug("pack merkle_root %s", util.ser_uint256_be(merkle_root_int).encode("hex"))
-        r += util.ser_uint256_be(merkle_root_int)
-        log.debug("pack ntime_bin %s", ntime_bin.encode("hex"))
-        r += ntime_bin
-        log.debug("pack nBits %s", struct.pack(">I", self.nBits).encode("hex"))
-        r += struct.pack(">I", self.nBits)
-        log.debug("pack nonce_bin %s", nonce_bin.encode("hex"))
-        r += nonce_bin
-        return r
+    def serialize_header_swapped(self, merkle_root_bin, ntime_bin, nonce_bin):
+        """Serialize header with every 4-byte word swapped, ready for hashing.
+        merkle_root_bin is little endian (as returned by MerkleTree),
+        ntime_bin and nonce_bin are in the form sent by the miner."""
+        return ''.join([self.header_prefix_swapped, merkle_root_bin,
+                        ntime_bin[::-1], self.nbits_swapped, nonce_bin[::-1]])
+
+    def serialize(self):
+        """Serialize block, only the header and coinbase are built here,
+        the rest of transactions was serialized in fill_from_rpc"""
+        return ''.join([struct.pack("<i", self.nVersion),
+                        util.ser_uint256(self.hashPrevBlock),
+                        util.ser_uint256(self.hashMerkleRoot),
+                        struct.pack("<III", self.nTime, self.nBits, self.nNonce),
+                        util.ser_compact_size(len(self.vtx)),
+                        self.vtx[0].serialize(),
+                        self.txs_serialized])
 
     def finalize(self, merkle_root_int, extranonce1_bin, extranonce2_bin, ntime, nonce):
         """Take all parameters required to compile block candidate.
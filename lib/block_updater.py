@@ -1,4 +1,4 @@
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 import settings
 
 import util
@@ -22,8 +22,21 @@ class BlockUpdater(object):
         self.bitcoin_rpc = bitcoin_rpc
         self.registry = registry
         self.clock = None
+        # Set while LongPollListener pushes new blocks, polling is relaxed then
+        self.relaxed = False
         self.schedule()
 
+    def set_relaxed(self, relaxed):
+        if relaxed == self.relaxed:
+            return
+        self.relaxed = relaxed
+        log.info("Prevhash polling every %d sec" % self._get_interval())
+
+        # Reschedule the waiting poll, a running one schedules itself
+        if self.clock is not None and self.clock.active():
+            self.clock.cancel()
+            self.schedule()
+
     def schedule(self):
         when = self._get_next_time()
         # log.debug("Next prevhash update in %.03f sec" % when)
@@ -31,17 +44,20 @@ class BlockUpdater(object):
         #          ((self.registry.last_update + settings.MERKLE_REFRESH_INTERVAL)-Interfaces.timestamper.time()))
         self.clock = reactor.callLater(when, self.run)
 
+    def _get_interval(self):
+        if self.relaxed:
+            return max(settings.PREVHASH_REFRESH_INTERVAL, settings.LONGPOLL_PREVHASH_REFRESH_INTERVAL)
+        return settings.PREVHASH_REFRESH_INTERVAL
+
     def _get_next_time(self):
         if self.registry.last_update is None:
             self.registry.last_update = 0.0
-        when = settings.PREVHASH_REFRESH_INTERVAL - (Interfaces.timestamper.time() - self.registry.last_update) % \
-               settings.PREVHASH_REFRESH_INTERVAL
+        interval = self._get_interval()
+        when = interval - (Interfaces.timestamper.time() - self.registry.last_update) % interval
         return when
 
     @defer.inlineCallbacks
     def run(self):
-        update = False
-
         try:
             if self.registry.last_block:
                 current_prevhash = "%064x" % self.registry.last_block.hashPrevBlock
@@ -53,16 +69,196 @@ class BlockUpdater(object):
             prevhash = yield self.bitcoin_rpc.prevhash()
             if prevhash and prevhash != current_prevhash:
                 log.info("New block! Prevhash: %s" % prevhash)
-                update = True
+                self.registry.update_block(new_block=True)
 
             elif Interfaces.timestamper.time() - self.registry.last_update >= settings.MERKLE_REFRESH_INTERVAL:
                 log.info("Merkle update! Prevhash: %s" % prevhash)
-                update = True
-
-            if update:
                 self.registry.update_block()
 
         except Exception:
             log.exception("UpdateWatchdog.run failed")
         finally:
             self.schedule()
+
+
+class LongPollListener(object):
+    """
+        Keeps a getblocktemplate long poll open at Dashcoind. The daemon
+        answers as soon as the chain tip changes, the returned template
+        is passed to registry.update_block without another RPC.
+
+        While the long poll works, polling of the given BlockUpdater
+        is relaxed. The listener stops when Dashcoind does not
+        support long polling (no longpollid in the template).
+    """
+
+    def __init__(self, registry, bitcoin_rpc, updater=None):
+        self.registry = registry
+        self.bitcoin_rpc = bitcoin_rpc
+        self.updater = updater
+        self.running = False
+        self.failures = 0
+
+    def start(self):
+        self.running = True
+        d = self.run()
+        d.addErrback(self._run_failed)
+        return d
+
+    def stop(self):
+        self.running = False
+        self._set_active(False)
+
+    def _set_active(self, active):
+        if self.updater is not None:
+            self.updater.set_relaxed(active)
+
+    def _run_failed(self, failure):
+        log.error("LongPollListener.run failed: %s" % failure.getErrorMessage())
+        self.stop()
+
+    def _get_backoff(self):
+        return min(settings.RPC_BACKOFF_MAX, settings.RPC_BACKOFF_MIN * 2 ** (self.failures - 1))
+
+    @defer.inlineCallbacks
+    def run(self):
+        longpollid = None
+
+        while self.running:
+            try:
+                if longpollid is None:
+                    data = yield self.bitcoin_rpc.getblocktemplate()
+                else:
+                    data = yield self.bitcoin_rpc.getblocktemplate_longpoll(longpollid)
+
+            except defer.TimeoutError:
+                # Dashcoind holds an RPC thread for every unanswered long poll,
+                # so a new one is sent only after a timeout longer than any
+                # realistic block gap. Polling covers the time meanwhile.
+                log.warning("Long poll not answered in %d sec, starting over" % settings.RPC_LONGPOLL_TIMEOUT)
+                longpollid = None
+                self._set_active(False)
+                continue
+
+            except Exception, e:
+                self.failures += 1
+                longpollid = None
+                self._set_active(False)
+                backoff = self._get_backoff()
+                log.error("Long poll failed, retrying in %d sec: %s" % (backoff, e))
+                yield task.deferLater(reactor, backoff, lambda: None)
+                continue
+
+            if not self.running:
+                break
+
+            self.failures = 0
+            if longpollid is not None:
+                self._on_template(data)
+
+            if not data.get('longpollid'):
+                log.warning("Dashcoind does not support long polling, falling back to polling")
+                self.stop()
+                break
+
+            longpollid = data['longpollid']
+            self._set_active(True)
+
+    def _on_template(self, data):
+        if self.registry.last_block is None or \
+                data['previousblockhash'] != self.registry.last_block.prevhash_hex:
+            log.info("New block! Prevhash: %s (long poll)" % data['previousblockhash'])
+            self.registry.update_block(data, new_block=True)
+
+        elif Interfaces.timestamper.time() - self.registry.last_update >= settings.MERKLE_REFRESH_INTERVAL:
+            log.info("Merkle update! Prevhash: %s (long poll)" % data['previousblockhash'])
+            self.registry.update_block(data)
+
+
+def _test():
+    # LongPollListener against a local stand-in of Dashcoind
+    import simplejson as json
+    from twisted.web import server, resource
+    from bitcoin_rpc import BitcoinRPC
+
+    state = {'tip': 'aa' * 32, 'longpoll': True, 'held': [], 'max_held': 0}
+
+    def template():
+        result = {'previousblockhash': state['tip'], 'height': 1}
+        if state['longpoll']:
+            result['longpollid'] = state['tip'] + '1'
+        return json.dumps({'result': result, 'error': None, 'id': '1'})
+
+    class Dashcoind(resource.Resource):
+        isLeaf = True
+
+        def render_POST(self, request):
+            params = json.loads(request.content.read())['params']
+            if params and params[0].get('longpollid', '')[:64] == state['tip']:
+                state['held'].append(request)
+                state['max_held'] = max(state['max_held'], len(state['held']))
+                return server.NOT_DONE_YET
+            return template()
+
+    def new_block(tip):
+        state['tip'] = tip
+        (held, state['held']) = (state['held'], [])
+        for request in held:
+            request.write(template())
+            request.finish()
+
+    class Block(object):
+        prevhash_hex = 'aa' * 32
+
+    class Registry(object):
+        last_block = Block()
+        updates = []
+
+        def update_block(self, data=None, new_block=False):
+            self.updates.append((data['previousblockhash'], new_block))
+
+    class Updater(object):
+        relaxed = False
+
+        def set_relaxed(self, relaxed):
+            self.relaxed = relaxed
+
+    port = reactor.listenTCP(0, server.Site(Dashcoind()), interface='127.0.0.1')
+    rpc = BitcoinRPC('127.0.0.1', port.getHost().port, 'user', 'password')
+    (registry, updater) = (Registry(), Updater())
+    listener = LongPollListener(registry, rpc, updater)
+
+    def wait(sec):
+        return task.deferLater(reactor, sec, lambda: None)
+
+    @defer.inlineCallbacks
+    def run():
+        listener.start()
+        yield wait(0.2)
+        assert updater.relaxed and len(state['held']) == 1
+
+        # Other calls are not blocked by the held long poll
+        result = yield rpc.getblocktemplate()
+        assert result['previousblockhash'] == 'aa' * 32
+
+        new_block('bb' * 32)
+        yield wait(0.2)
+        assert registry.updates == [('bb' * 32, True)]
+        assert len(state['held']) == 1 and state['max_held'] == 1
+
+        # Dashcoind without long polling, the last template is still used
+        state['longpoll'] = False
+        new_block('cc' * 32)
+        yield wait(0.2)
+        assert registry.updates[-1] == ('cc' * 32, True)
+        assert not listener.running and not updater.relaxed
+        print "LongPollListener OK"
+
+    d = run()
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    _test()
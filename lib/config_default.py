@@ -24,6 +24,12 @@ LOG_ROTATION = True
 LOG_SIZE = 10485760 # Rotate every 10M
 LOG_RETENTION = 10 # Keep 10 Logs
 
+# Write logs from a background thread, so the reactor never waits for the disk.
+# When more than LOG_ASYNC_QUEUE_SIZE records are waiting, new records are dropped
+# and their count is logged once the writer catches up.
+LOG_ASYNC = False
+LOG_ASYNC_QUEUE_SIZE = 10000
+
 # How many threads use for synchronous methods (services).
 # 30 is enough for small installation, for real usage
 # it should be slightly more, say 100-300.
@@ -165,6 +171,96 @@ DATABASE_USER = 'marekp_bitcointe'
 DATABASE_PASSWORD = '**empty**'
 '''
 
+# ******************** Dashcoind RPC SETTINGS *********************
+
+# Failed Dashcoind is tried after the healthy ones for RPC_BACKOFF_MIN seconds,
+# the time doubles with every next failure up to RPC_BACKOFF_MAX.
+RPC_BACKOFF_MIN = 1
+RPC_BACKOFF_MAX = 60
+
+# Seconds to wait for an answer of Dashcoind (submitblock has its own limit)
+RPC_TIMEOUT = 30
+RPC_SUBMITBLOCK_TIMEOUT = 60
+RPC_CONNECT_TIMEOUT = 5
+
+# Keep-alive connections to every Dashcoind
+RPC_MAX_PERSISTENT = 4          # Max idle connections kept open
+RPC_KEEPALIVE_TIMEOUT = 240     # Close idle connections after this many seconds
+
+# Max requests sent to one Dashcoind at the same time, others wait in a queue
+RPC_MAX_IN_FLIGHT = 8
+
+# getblocktemplate long poll, Dashcoind pushes new blocks without polling.
+# Long polls are not counted in RPC_MAX_IN_FLIGHT. A new long poll is sent
+# only when Dashcoind answered the previous one or RPC_LONGPOLL_TIMEOUT
+# expired, an abandoned long poll keeps one of its -rpcthreads busy.
+LONGPOLL_ENABLED = True
+RPC_LONGPOLL_TIMEOUT = 1800                 # Longer than any realistic block gap
+LONGPOLL_PREVHASH_REFRESH_INTERVAL = 30     # Used instead of PREVHASH_REFRESH_INTERVAL while long poll works
+
+# Template update (getblocktemplate including failover) which did not finish
+# in this many seconds is abandoned, so it does not block next updates
+TEMPLATE_UPDATE_TIMEOUT = 90
+
+# ******************** DATABASE SETTINGS *********************
+
+# Max share records sent in one multi-row INSERT statement.
+# All chunks of one loader run are committed in a single transaction.
+DB_LOADER_CHUNK_SIZE = 500
+
+# Connection pool shared by the reactor and the share import threads.
+DB_POOL_SIZE = 5            # Max open connections
+DB_POOL_MAX_IDLE = 300      # Close connections unused for this many seconds
+DB_POOL_PING_INTERVAL = 30  # Ping connections unused for this many seconds before reuse
+DB_POOL_TIMEOUT = 10        # Max seconds to wait for a free connection
+DB_POOL_BACKOFF_MIN = 1     # Wait after a failed connection attempt, doubled on every failure
+DB_POOL_BACKOFF_MAX = 60    # ... up to this many seconds
+
+# Threads running the blocking DB queries outside of the reactor.
+DB_THREAD_POOL_SIZE = 5
+
+# Worker difficulty changes are buffered and written in one statement this often (seconds).
+DB_WORKER_DIFF_FLUSH_TIME = 5
+
+# ******************** SHARE SETTINGS *********************
+
+# Keep submitted shares of every job grouped by extranonce1 (per connection).
+SUBMITS_SPLIT_BY_EXTRANONCE1 = False
+
+# Maximum of registered shares per job, 0 means no limit.
+# Once it is reached, further shares for that job are rejected with "Too many shares for job".
+SUBMITS_MAX_PER_JOB = 0
+
+# Number of worker processes calculating x11 hashes of submitted shares.
+# 0 keeps share validation in the main process.
+SHARE_WORKER_PROCESSES = 0
+
+# Shares waiting for worker processes. When exceeded, connections which
+# submit more shares are paused until the queue drops to a half.
+SHARE_WORKER_QUEUE_MAX = 1000
+
+# Shares not hashed in this many seconds (e.g. the worker process died)
+# are rejected and removed from the queue.
+SHARE_WORKER_TIMEOUT = 10
+
+# Number of threads hashing shares when SHARE_WORKER_PROCESSES is 0.
+# Helps only if the x11 module releases the GIL.
+SHARE_WORKER_THREADS = 0
+
+# Shares submitted within this window (seconds) are sent to the worker
+# processes or threads as one task. They are still hashed one by one, this
+# only cuts dispatching costs during bursts of submits. Needs
+# SHARE_WORKER_PROCESSES or SHARE_WORKER_THREADS. 0 disables batching.
+SHARE_BATCH_WINDOW = 0
+SHARE_BATCH_MAX = 100              # Hash the batch as soon as it has this many shares
+SHARE_BATCH_STATS_INTERVAL = 60    # Log batch sizes and added latency this often (seconds)
+
+# ******************** BROADCAST SETTINGS *********************
+
+# Number of connections which receive a new job per reactor iteration.
+# Submits are processed between the chunks. 0 sends the job to all connections at once.
+NOTIFY_BROADCAST_CHUNK = 0
+
 #VADRIFF
 # Variable Difficulty Enable
 VARIABLE_DIFF = False        # Master variable difficulty enable
@@ -1,4 +1,9 @@
 from stratum.custom_exceptions import ServiceException
 
 class SubmitException(ServiceException):
-    pass
\ No newline at end of file
+    pass
+
+
+class RPCError(Exception):
+    '''Error returned by Dashcoind for one call of a JSON-RPC batch'''
+    pass
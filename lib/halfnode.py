@@ -206,6 +206,50 @@ class CTransaction(object):
         self.nVersion32, repr(self.vin), repr(self.vout), self.nLockTime)
 
 
+class CRawTransaction(object):
+    """Transaction kept as serialized by the daemon.
+
+    serialize() returns the original bytes, so the transaction is written
+    into a block without touching its fields. CTxIn/CTxOut objects are built
+    on the first access to any other CTransaction attribute."""
+
+    def __init__(self, raw, sha256=None):
+        self.raw = raw
+        self.sha256 = sha256
+        self._tx = None
+
+    def _parsed(self):
+        if self._tx is None:
+            tx = CTransaction()
+            tx.deserialize(cStringIO.StringIO(self.raw))
+            self._tx = tx
+        return self._tx
+
+    def __getattr__(self, name):
+        # Called only for attributes missing on this object
+        if name.startswith('__') or name in ('raw', '_tx'):
+            raise AttributeError(name)
+        return getattr(self._parsed(), name)
+
+    def serialize(self):
+        return self.raw
+
+    def calc_sha256(self):
+        if self.sha256 is None:
+            self.sha256 = uint256_from_str(SHA256.new(SHA256.new(self.raw).digest()).digest())
+        return self.sha256
+
+    def is_valid(self):
+        self.calc_sha256()
+        for tout in self.vout:
+            if tout.nValue < 0 or tout.nValue > 21000000L * 100000000L:
+                return False
+        return True
+
+    def __repr__(self):
+        return "CRawTransaction(%s)" % binascii.hexlify(self.raw)
+
+
 class CBlock(object):
     def __init__(self):
         self.nVersion = 1
@@ -1,7 +1,11 @@
 '''Simple wrapper around python's logging package'''
 
 import os
+import time
+import binascii
 import logging
+import threading
+import Queue
 from logging import handlers
 from twisted.python import log as twisted_log
 
@@ -26,13 +30,127 @@ class Logger(object):
 '''
 
 
+class LazyHex(object):
+    '''Hex form of binary data as a log argument, e.g.
+    log.debug("hash %s", LazyHex(hash_bin)). Nothing is converted
+    unless the record is really emitted.'''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data)
+
+
+class LazyUint256(object):
+    '''uint256 number formatted as 64 hex digits when the record is emitted'''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "%064x" % self.value
+
+
+def debug_enabled(logger):
+    '''Guard for debug logging which needs extra work to prepare
+    its arguments: if debug_enabled(log): log.debug(...)'''
+    return logger.isEnabledFor(logging.DEBUG)
+
+
+class AsyncHandler(logging.Handler):
+    '''Hands records over to a background thread, which passes them
+    to the given handlers. The caller never waits for the disk.
+
+    The queue holds at most queue_size records. Records which do not
+    fit are dropped and counted; the writer logs the count when it
+    catches up, or every summary_interval seconds under long overload.'''
+
+    summary_interval = 10
+
+    def __init__(self, handlers, queue_size):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.last_summary = 0
+
+        self.thread = threading.Thread(target=self._run, name='AsyncLogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        # Arguments are formatted now, they may change before the writer
+        # gets to them. Tracebacks are rendered for the same reason.
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = fmt.formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped_lock.acquire()
+            self.dropped += 1
+            self.dropped_lock.release()
+
+    def _take_dropped(self):
+        self.dropped_lock.acquire()
+        try:
+            (dropped, self.dropped) = (self.dropped, 0)
+        finally:
+            self.dropped_lock.release()
+        return dropped
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            self._write(record)
+
+            if self.dropped and (self.queue.empty() or
+                                 time.time() - self.last_summary >= self.summary_interval):
+                self.last_summary = time.time()
+                self._write(logging.LogRecord('logger', logging.WARNING, __file__, 0,
+                                              "Log queue full, dropped %d records" % self._take_dropped(),
+                                              None, None))
+
+    def close(self):
+        # Let the writer finish queued records, but do not hang the exit
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+            except Queue.Full:
+                pass
+            self.thread.join(5)
+        logging.Handler.close(self)
+
+
 def get_logger(name):
     logger = logging.getLogger(name)
-    logger.addHandler(stream_handler)
     logger.setLevel(getattr(logging, settings.LOGLEVEL))
 
-    if settings.LOGFILE != None:
-        logger.addHandler(file_handler)
+    if settings.LOG_ASYNC:
+        logger.addHandler(async_handler)
+    else:
+        logger.addHandler(stream_handler)
+        if settings.LOGFILE != None:
+            logger.addHandler(file_handler)
 
     logger.debug("Logging initialized")
     return logger
@@ -61,3 +179,53 @@ if settings.LOGFILE != None:
 
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(fmt)
+
+if settings.LOG_ASYNC:
+    if settings.LOGFILE != None:
+        async_handler = AsyncHandler([stream_handler, file_handler], settings.LOG_ASYNC_QUEUE_SIZE)
+    else:
+        async_handler = AsyncHandler([stream_handler], settings.LOG_ASYNC_QUEUE_SIZE)
+
+
+def _bench(count=20000):
+    """Per-share cost of debug logging of submit_share at INFO and DEBUG,
+    eagerly formatted arguments against guarded/lazy ones"""
+    import os
+    import timeit
+    import StringIO
+
+    logger = logging.getLogger('logger_bench')
+    logger.propagate = False
+    handler = logging.StreamHandler(StringIO.StringIO())
+    handler.setFormatter(fmt)
+    logger.addHandler(handler)
+
+    extranonce1_bin = os.urandom(4)
+    coinbase_hash = os.urandom(32)
+    hash_int = long(binascii.hexlify(os.urandom(32)), 16)
+    target = hash_int + 1
+
+    def eager():
+        logger.debug("TemplateRegistry submit_share")
+        logger.debug("from %s, (%s %s %s %s)" % ('worker', binascii.hexlify(extranonce1_bin),
+                                                 '00000001', '5f5e1000', '00000000'))
+        logger.debug("coinbase_hash: %s", coinbase_hash[::-1].encode("hex"))
+        logger.debug("hash_int: %064x, target_user: %064x" % (hash_int, target))
+
+    def lazy():
+        if debug_enabled(logger):
+            logger.debug("TemplateRegistry submit_share")
+            logger.debug("from %s, (%s %s %s %s)", 'worker', LazyHex(extranonce1_bin),
+                         '00000001', '5f5e1000', '00000000')
+            logger.debug("coinbase_hash: %s", LazyHex(coinbase_hash[::-1]))
+            logger.debug("hash_int: %s, target_user: %s", LazyUint256(hash_int), LazyUint256(target))
+
+    for level in ('INFO', 'DEBUG'):
+        logger.setLevel(getattr(logging, level))
+        t_eager = timeit.timeit(eager, number=count) / count
+        t_lazy = timeit.timeit(lazy, number=count) / count
+        print "%-5s eager %7.2f us, lazy %7.2f us per share" % (level, t_eager * 1e6, t_lazy * 1e6)
+
+
+if __name__ == '__main__':
+    _bench()
@@ -18,13 +18,26 @@ from hashlib import sha256
 from util import doublesha
 
 
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
 class MerkleTree:
-    def __init__(self, data, detailed=False):
+    def __init__(self, data, detailed=False, previous=None):
         self.data = data
-        self.recalculate(detailed)
+        self._levels = None
+        self.recalculate(detailed, previous)
         self._hash_steps = None
 
-    def recalculate(self, detailed=False):
+    def recalculate(self, detailed=False, previous=None):
+        if not detailed:
+            self._recalculate_levels(previous)
+            return
+
         L = self.data
         steps = []
         if detailed:
@@ -50,6 +63,46 @@ class MerkleTree:
         self._steps = steps
         self.detail = detail
 
+    def _recalculate_levels(self, previous=None):
+        """Calculate _steps keeping all interior nodes in self._levels.
+
+        Nodes of the previous tree are reused as long as both of their
+        children are unchanged, so for data which only grew at the tail
+        just the right edge is hashed again. Identical data reuses
+        the previous tree outright. The first item of every level
+        (coinbase path) is never calculated, it stays None."""
+        L = list(self.data)
+        self.detail = None
+
+        old_levels = []
+        if previous is not None and previous._levels is not None:
+            old_levels = previous._levels
+            if old_levels[0] == L:
+                self._levels = old_levels
+                self._steps = previous._steps
+                return
+
+        levels = [L]
+        steps = []
+        same = _common_prefix(L, old_levels[0]) if old_levels else 0
+        while len(L) > 1:
+            steps.append(L[1])
+            old_parent = old_levels[len(levels)] if len(levels) < len(old_levels) else []
+
+            # Parent j is the same when children 2j and 2j+1 are the same
+            reuse = min(same // 2, len(old_parent))
+            parent = [None] + old_parent[1:reuse]
+            Ll = len(L)
+            for i in xrange(2 * len(parent), Ll, 2):
+                parent.append(doublesha(L[i] + L[min(i + 1, Ll - 1)]))
+
+            L = parent
+            levels.append(L)
+            same = reuse
+
+        self._levels = levels
+        self._steps = steps
+
     def hash_steps(self):
         if self._hash_steps == None:
             self._hash_steps = doublesha(''.join(self._steps))
@@ -133,8 +186,35 @@ def _testTxesMerkleRoot():
     ]])
 
     print binascii.b2a_hex(mt.withFirst(util.ser_uint256(int("a9c02cb69f753ef724110f7a0b95724492ded6ac1333f22424de0b8eafdb35a2", 16))))
+
+
+def _testIncremental():
+    import os
+
+    for n in (1, 2, 3, 4, 5, 17, 64, 100):
+        txes = [None] + [os.urandom(32) for i in xrange(n)]
+        prev = MerkleTree(list(txes[:n // 2 + 1]))
+        for data in (txes, txes[:n // 3 + 1], txes[:2] + [os.urandom(32)] + txes[3:], txes + txes[1:4]):
+            mt = MerkleTree(list(data), previous=prev)
+            assert mt._steps == _stepsOf(data)
+            prev = mt
+        assert MerkleTree(list(prev.data), previous=prev)._steps is prev._steps
+    print 'ok'
+
+
+def _stepsOf(data):
+    # Reference implementation, the original non-detailed algorithm
+    L = list(data)
+    steps = []
+    while len(L) > 1:
+        steps.append(L[1])
+        if len(L) % 2:
+            L += [L[-1]]
+        L = [None] + [doublesha(L[i] + L[i + 1]) for i in range(2, len(L), 2)]
+    return steps
     
 
 if __name__ == '__main__':
     # _test()
     _testTxesMerkleRoot()
+    _testIncremental()
@@ -0,0 +1,243 @@
+import time
+import signal
+import multiprocessing
+
+import pyX11
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool, failure
+
+import lib.logger
+
+log = lib.logger.get_logger('share_validator')
+
+
+def _init_worker():
+    # Ctrl+C is handled by the main process, it terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _hash_headers(headers):
+    # Runs in a worker process or thread. Pool.apply_async in Python 2.7
+    # has no error callback, so errors are returned as results.
+    results = []
+    for header in headers:
+        try:
+            results.append((True, pyX11.x11_hash(header)))
+        except Exception, e:
+            results.append((False, "%s: %s" % (e.__class__.__name__, e)))
+    return results
+
+
+def _first_result(results):
+    (ok, value) = results[0]
+    if not ok:
+        raise Exception("Share hashing failed: %s" % value)
+    return value
+
+
+class _QueuedShareHasher(object):
+    """Keeps count of queued headers. When more than queue_max headers
+    are waiting, transports passed to throttle() stop reading until
+    the queue drops to half of queue_max.
+
+    A batch which is not hashed in timeout seconds (e.g. its worker
+    process died) fails with TimeoutError and leaves the queue."""
+
+    def __init__(self, queue_max, timeout):
+        self.queue_max = queue_max
+        self.timeout = timeout
+        self.pending = 0
+        self.paused = set()
+
+    def _run(self, headers):
+        """Returns Deferred fired with _hash_headers(headers),
+        subclasses hash outside of the reactor thread."""
+        return defer.succeed(_hash_headers(headers))
+
+    def hash_batch(self, headers):
+        """Returns Deferred fired in the reactor thread with
+        (True, hash_bin) or (False, error message) for every header."""
+        self.pending += len(headers)
+        d = defer.Deferred()
+        d.addBoth(self._done, len(headers))
+
+        timeout_call = reactor.callLater(self.timeout, self._timed_out, d)
+        self._run(headers).addBoth(self._finished, d, timeout_call)
+        return d
+
+    def _finished(self, result, d, timeout_call):
+        if d.called:
+            # Timed out already, the late result is dropped
+            return
+        timeout_call.cancel()
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def _timed_out(self, d):
+        log.error("Share batch not hashed in %s sec, dropping it" % self.timeout)
+        d.errback(defer.TimeoutError("Share hashing did not finish in %s sec" % self.timeout))
+
+    def hash(self, header):
+        d = self.hash_batch([header])
+        d.addCallback(_first_result)
+        return d
+
+    def _done(self, result, count):
+        self.pending -= count
+        if self.paused and self.pending <= self.queue_max // 2:
+            self._resume()
+        return result
+
+    def throttle(self, transport):
+        """Stop reading from the transport while the queue is full"""
+        if self.pending < self.queue_max or transport in self.paused:
+            return
+
+        if not hasattr(transport, 'pauseProducing'):
+            return
+
+        if not self.paused:
+            log.warning("Share validation queue is full (%d), pausing connections" % self.pending)
+        transport.pauseProducing()
+        self.paused.add(transport)
+
+    def _resume(self):
+        log.info("Share validation queue drained, resuming %d connections" % len(self.paused))
+        for transport in self.paused:
+            try:
+                transport.resumeProducing()
+            except Exception:
+                # Connection has been closed meanwhile
+                pass
+        self.paused = set()
+
+
+class ShareHasher(_QueuedShareHasher):
+    """Calculates x11 hashes of share headers in a pool of worker
+    processes, so share validation is not limited to the reactor thread."""
+
+    def __init__(self, processes, queue_max, timeout):
+        _QueuedShareHasher.__init__(self, queue_max, timeout)
+        self.pool = multiprocessing.Pool(processes, _init_worker)
+        log.info("Started %d share validation processes" % processes)
+
+    def _run(self, headers):
+        d = defer.Deferred()
+        self.pool.apply_async(_hash_headers, (headers,),
+                              callback=lambda results: reactor.callFromThread(d.callback, results))
+        return d
+
+    def close(self):
+        self.pool.terminate()
+
+
+class ThreadShareHasher(_QueuedShareHasher):
+    """Calculates x11 hashes of share headers in a pool of threads.
+    It runs in parallel only if the x11 module releases the GIL."""
+
+    def __init__(self, threads, queue_max, timeout):
+        _QueuedShareHasher.__init__(self, queue_max, timeout)
+        self.threadpool = threadpool.ThreadPool(1, threads, 'ShareHasher')
+        self.threadpool.start()
+        log.info("Started %d share validation threads" % threads)
+
+    def _run(self, headers):
+        return threads.deferToThreadPool(reactor, self.threadpool, _hash_headers, headers)
+
+    def close(self):
+        self.threadpool.stop()
+
+
+class BatchingShareHasher(object):
+    """Collects headers submitted within window seconds (at most max_size
+    of them) and sends them to the backend (ShareHasher or ThreadShareHasher)
+    as one task. The worker still hashes the headers one by one, batching
+    only saves the cost of dispatching a task per share.
+
+    Batch sizes and latency added by waiting for the batch are logged
+    every stats_interval seconds."""
+
+    def __init__(self, backend, window, max_size, stats_interval=60):
+        self.backend = backend
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.stats_interval = stats_interval
+
+        self.headers = []
+        self.deferreds = []
+        self.started = None
+        self.clock = None
+
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats_since = time.time()
+        self.stats_batches = 0
+        self.stats_shares = 0
+        self.stats_max_size = 0
+        self.stats_wait = 0.0
+        self.stats_max_wait = 0.0
+
+    def _update_stats(self, size, wait):
+        self.stats_batches += 1
+        self.stats_shares += size
+        self.stats_max_size = max(self.stats_max_size, size)
+        self.stats_wait += wait
+        self.stats_max_wait = max(self.stats_max_wait, wait)
+
+        if time.time() - self.stats_since >= self.stats_interval:
+            log.info("Share batches: %d batches, %d shares, %.1f avg / %d max per batch, "
+                     "added latency %.2f ms avg / %.2f ms max" % \
+                     (self.stats_batches, self.stats_shares, float(self.stats_shares) / self.stats_batches,
+                      self.stats_max_size, self.stats_wait * 1000 / self.stats_batches, self.stats_max_wait * 1000))
+            self._reset_stats()
+
+    def hash(self, header):
+        d = defer.Deferred()
+        if not self.headers:
+            self.started = time.time()
+        self.headers.append(header)
+        self.deferreds.append(d)
+
+        if len(self.headers) >= self.max_size:
+            self.flush()
+        elif self.clock is None:
+            self.clock = reactor.callLater(self.window, self.flush)
+        return d
+
+    def flush(self):
+        if self.clock is not None and self.clock.active():
+            self.clock.cancel()
+        self.clock = None
+
+        (headers, deferreds) = (self.headers, self.deferreds)
+        self.headers = []
+        self.deferreds = []
+        if not headers:
+            return
+
+        self._update_stats(len(headers), time.time() - self.started)
+
+        d = self.backend.hash_batch(headers)
+        d.addCallbacks(self._batch_done, self._batch_failed,
+                       callbackArgs=(deferreds,), errbackArgs=(deferreds,))
+
+    def _batch_done(self, results, deferreds):
+        for (d, (ok, value)) in zip(deferreds, results):
+            if ok:
+                d.callback(value)
+            else:
+                d.errback(Exception("Share hashing failed: %s" % value))
+
+    def _batch_failed(self, failure, deferreds):
+        log.error("Share batch failed: %s" % failure.getErrorMessage())
+        for d in deferreds:
+            d.errback(failure)
+
+    def throttle(self, transport):
+        self.backend.throttle(transport)
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,64 @@
+import lib.logger
+
+log = lib.logger.get_logger('submit_set')
+
+
+class SubmitSet(object):
+    """Set of already submitted shares of one job.
+
+    Every share is stored as a fixed-width binary key built from its
+    (extranonce1, extranonce2, ntime, nonce). Sizes of all parts are
+    checked before the share is registered, so the concatenation is
+    unambiguous. Hex case of the submitted parts does not matter,
+    the same share sent in upper and lower case is a duplicate.
+
+    With split_by_extranonce1 the keys are grouped by extranonce1,
+    so every connection gets its own (smaller) set.
+
+    max_keys limits the memory used by one job, 0 means no limit.
+    Callers check is_full() before add() and reject new shares
+    of a full set, reject_full() counts them."""
+
+    def __init__(self, split_by_extranonce1=False, max_keys=0):
+        self.split_by_extranonce1 = split_by_extranonce1
+        self.max_keys = max_keys
+        self.count = 0
+        self.overflow = 0
+
+        if split_by_extranonce1:
+            self.keys = {}
+        else:
+            self.keys = set()
+
+    def __len__(self):
+        return self.count
+
+    def is_full(self):
+        return self.max_keys > 0 and self.count >= self.max_keys
+
+    def reject_full(self):
+        """Counts a share rejected because the set is full,
+        the first one is logged."""
+        if not self.overflow:
+            log.warning("Limit of %d submits per job reached, rejecting new shares" % self.max_keys)
+        self.overflow += 1
+
+    def add(self, extranonce1, extranonce2, ntime, nonce):
+        """Register the share. Returns False when the share
+        has been already registered."""
+
+        if self.split_by_extranonce1:
+            keys = self.keys.get(extranonce1)
+            key = extranonce2 + ntime + nonce
+        else:
+            keys = self.keys
+            key = extranonce1 + extranonce2 + ntime + nonce
+
+        if keys is not None and key in keys:
+            return False
+
+        if keys is None:
+            keys = self.keys[extranonce1] = set()
+        keys.add(key)
+        self.count += 1
+        return True
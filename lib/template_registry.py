@@ -3,15 +3,45 @@ import binascii
 import util
 import StringIO
 import pyX11
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from lib.exceptions import SubmitException
 
+import settings
+
 import lib.logger
+from lib.logger import LazyHex, LazyUint256, debug_enabled
 
 log = lib.logger.get_logger('template_registry')
 
 from mining.interfaces import Interfaces
 from extranonce_counter import ExtranonceCounter
+from transaction_cache import TransactionCache
+
+# Target of difficulty 1
+DIFF1 = 0x00000000ffff0000000000000000000000000000000000000000000000000000
+# DIFF1 = 0x0000ffff00000000000000000000000000000000000000000000000000000000
+
+# Shares below this target are logged, mostly for debugging purposes
+TARGET_INFO = DIFF1 / 100000
+
+
+def template_fingerprint(data):
+    '''Everything in getblocktemplate result which changes the jobs
+    sent to miners. curtime is left out, miners roll ntime themselves.'''
+    payees = tuple([(p.get('payee'), p.get('script'), p.get('amount'))
+                    for p in data.get('masternode', []) + data.get('superblock', [])])
+    return (data['previousblockhash'], data['height'], data['version'], data['bits'],
+            data['coinbasevalue'], data['coinbaseaux']['flags'], data['coinbase_payload'],
+            tuple([t['hash'] for t in data['transactions']]), payees)
+
+
+def _share_hashing_failed(failure):
+    '''Share which could not be hashed (e.g. its worker died) is rejected
+    like any other invalid share, so it is recorded by the share manager.'''
+    if failure.check(defer.TimeoutError):
+        raise SubmitException("Share hashing timed out")
+    log.error("Share hashing failed: %s" % failure.getErrorMessage())
+    raise SubmitException("Share hashing failed")
 
 
 class JobIdGenerator(object):
@@ -27,6 +57,24 @@ class JobIdGenerator(object):
         return "%x" % cls.counter
 
 
+class PendingShare(object):
+    '''Share which passed all checks of TemplateRegistry.prepare_share,
+    only its proof of work is not verified yet.'''
+
+    def __init__(self, job, job_id, session, difficulty, extranonce1_bin, extranonce2_bin,
+                 ntime, nonce, merkle_root_bin, header_swapped):
+        self.job = job
+        self.job_id = job_id
+        self.session = session
+        self.difficulty = difficulty
+        self.extranonce1_bin = extranonce1_bin
+        self.extranonce2_bin = extranonce2_bin
+        self.ntime = ntime
+        self.nonce = nonce
+        self.merkle_root_bin = merkle_root_bin
+        self.header_swapped = header_swapped
+
+
 class TemplateRegistry(object):
     '''Implements the main logic of the pool. Keep track
     on valid block templates, provide internal interface for stratum
@@ -51,9 +99,23 @@ class TemplateRegistry(object):
         self.on_template_callback = on_template_callback
 
         self.last_block = None
-        self.update_in_progress = False
+        self.last_fingerprint = None
+        # Parsed transactions of the last template, reused by the next one
+        self.tx_cache = TransactionCache()
         self.last_update = None
 
+        # Only one getblocktemplate at a time. Triggers which arrive
+        # meanwhile are merged into a single follow-up update.
+        self.update_in_progress = False
+        self.update_new_block = False  # The running update was triggered by a new block
+        self.update_pending = None  # new_block flag of the follow-up, None = no follow-up
+        self.update_pending_data = None
+        self.update_generation = 0  # Results of older (abandoned) updates are ignored
+        self.update_timeout = None
+
+        # Optional ShareHasher, hashes share headers in worker processes
+        self.share_hasher = None
+
         # Create first block template on startup
         self.update_block()
 
@@ -69,6 +131,10 @@ class TemplateRegistry(object):
         log.debug("TemplateRegistry get_last_broadcast_args")
         return self.last_block.broadcast_args
 
+    def get_last_notify_frame(self, clean_jobs):
+        '''Returns encoded mining.notify line of last known template.'''
+        return self.last_block.notify_frames[clean_jobs]
+
     def add_template(self, block, block_height):
         '''Adds new template to the registry.
         It also clean up templates which should
@@ -95,6 +161,7 @@ class TemplateRegistry(object):
         # Drop templates of obsolete blocks
         for ph in self.prevhashes.keys():
             if ph != prevhash:
+                self._log_submits(self.prevhashes[ph])
                 del self.prevhashes[ph]
 
         log.debug("New template for %s" % prevhash)
@@ -110,66 +177,144 @@ class TemplateRegistry(object):
         # from twisted.internet import reactor
         # reactor.callLater(10, self.on_block_callback, new_block)
 
-    def update_block(self):
+    def _log_submits(self, templates):
+        '''Reports how many share keys were held by dropped templates.'''
+        counts = [t.get_submits_count() for t in templates]
+        if counts:
+            log.info("Dropped %d templates holding %d submit keys (max %d per job)" % \
+                     (len(counts), sum(counts), max(counts)))
+
+    def update_block(self, data=None, new_block=False):
         '''Registry calls the getblocktemplate() RPC
-        and build new block template.'''
+        and build new block template. Result of getblocktemplate
+        which is already known (e.g. from a long poll) can be passed
+        as data, the RPC is skipped then.
+
+        new_block should be set when the trigger knows about a new
+        block on the network. Such update replaces a running merkle
+        refresh, other triggers are merged into one follow-up update
+        which starts when the running one finishes.'''
         log.debug("TemplateRegistry update_block")
         if self.update_in_progress:
-            # Block has been already detected
-            return
+            if new_block and not self.update_new_block:
+                log.info("New block during merkle refresh, replacing the refresh")
+                # The new block update fetches a fresh template anyway
+                if self.update_pending is False:
+                    self.update_pending = None
+                    self.update_pending_data = None
+            else:
+                self.update_pending = bool(self.update_pending) or new_block
+                # The latest trigger decides whether the follow-up needs the RPC
+                self.update_pending_data = data
+                log.debug("Update in progress, follow-up update queued")
+                return
+
+        self._start_update(data, new_block)
+
+    def _start_update(self, data, new_block):
+        self.update_generation += 1
+        generation = self.update_generation
 
         self.update_in_progress = True
+        self.update_new_block = new_block
         self.last_update = Interfaces.timestamper.time()
 
-        d = self.bitcoin_rpc.getblocktemplate()
-        d.addCallback(self._update_block)
-        d.addErrback(self._update_block_failed)
+        if self.update_timeout is not None and self.update_timeout.active():
+            self.update_timeout.cancel()
+        self.update_timeout = reactor.callLater(settings.TEMPLATE_UPDATE_TIMEOUT,
+                                                self._update_block_timeout, generation)
+
+        if data is not None:
+            d = defer.succeed(data)
+        else:
+            d = self.bitcoin_rpc.getblocktemplate()
+        d.addCallback(self._update_block, generation)
+        d.addErrback(self._update_block_failed, generation)
+
+    def _update_done(self):
+        if self.update_timeout is not None and self.update_timeout.active():
+            self.update_timeout.cancel()
+        self.update_timeout = None
+        self.update_in_progress = False
+
+        if self.update_pending is not None:
+            (new_block, data) = (self.update_pending, self.update_pending_data)
+            self.update_pending = None
+            self.update_pending_data = None
+            self._start_update(data, new_block)
+
+    def _update_block_timeout(self, generation):
+        if generation != self.update_generation:
+            return
+        log.error("Template update did not finish in %d sec, abandoning it" % settings.TEMPLATE_UPDATE_TIMEOUT)
+        # Result of the stuck call is ignored whenever it arrives
+        self.update_generation += 1
+        self._update_done()
 
-    def _update_block_failed(self, failure):
+    def _update_block_failed(self, failure, generation):
         log.debug("TemplateRegistry _update_block_failed")
+        if generation != self.update_generation:
+            return
         log.error(str(failure))
-        self.update_in_progress = False
+        self._update_done()
 
-    def _update_block(self, data):
+    def _update_block(self, data, generation):
         log.debug("TemplateRegistry _update_block")
+        if generation != self.update_generation:
+            log.debug("Dropping result of replaced template update")
+            return data
+
         start = Interfaces.timestamper.time()
 
+        # Nothing new since the last template, keep miners on current jobs
+        fingerprint = template_fingerprint(data)
+        if self.last_block is not None and fingerprint == self.last_fingerprint:
+            log.debug("Template unchanged, %d txes, skipping update" % len(data['transactions']))
+            self._update_done()
+            return data
+
         template = self.block_template_class(Interfaces.timestamper, self.coinbaser, JobIdGenerator.get_new_id())
-        template.fill_from_rpc(data)
+        template.fill_from_rpc(data, self.tx_cache)
         self.add_template(template, data['height'])
+        self.last_fingerprint = fingerprint
 
         log.debug("Update finished, %.03f sec, %d txes" % \
                   (Interfaces.timestamper.time() - start, len(template.vtx)))
         log.debug("block template: %s", data)
 
-        self.update_in_progress = False
+        self._update_done()
         return data
 
     def diff_to_target(self, difficulty):
         '''Converts difficulty to target'''
         log.debug("TemplateRegistry diff_to_target")
-        diff1 = 0x00000000ffff0000000000000000000000000000000000000000000000000000
-        # diff1 = 0x0000ffff00000000000000000000000000000000000000000000000000000000
-        return diff1 / difficulty
+        return DIFF1 / difficulty
+
+    def get_session_target(self, session, key, difficulty):
+        '''Returns diff_to_target(difficulty), cached in session[key].
+        The target is calculated again only when the difficulty changes.'''
+        cached = session.get(key)
+        if cached is None or cached[0] != difficulty:
+            cached = session[key] = (difficulty, self.diff_to_target(difficulty))
+        return cached[1]
 
     def get_job(self, job_id):
-        log.debug("TemplateRegistry get_job")
         '''For given job_id returns BlockTemplate instance or None'''
         try:
             j = self.jobs[job_id]
         except:
-            log.debug("Job id '%s' not found" % job_id)
+            log.debug("Job id '%s' not found", job_id)
             return None
 
         # Now we have to check if job is still valid.
         # Unfortunately weak references are not bulletproof and
         # old reference can be found until next run of garbage collector.
         if j.prevhash_hex not in self.prevhashes:
-            log.debug("Prevhash of job '%s' is unknown" % job_id)
+            log.debug("Prevhash of job '%s' is unknown", job_id)
             return None
 
         if j not in self.prevhashes[j.prevhash_hex]:
-            log.debug("Job %s is unknown" % job_id)
+            log.debug("Job %s is unknown", job_id)
             return None
 
         return j
@@ -186,9 +331,40 @@ class TemplateRegistry(object):
             - submitblock_callback - reference to method which receive result of submitblock()
         '''
 
-        log.debug("TemplateRegistry submit_share")
-        log.debug(
-            "from %s, (%s %s %s %s)" % (worker_name, binascii.hexlify(extranonce1_bin), extranonce2, ntime, nonce))
+        share = self.prepare_share(job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
+                                   difficulty)
+        return self.finish_share(share, pyX11.x11_hash(share.header_swapped))
+
+    def submit_share_deferred(self, job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
+                              difficulty):
+        '''Same as submit_share, but returns Deferred. When share_hasher
+        is set, the header is hashed outside of the reactor thread.
+        Duplicate and job checks are always done immediately.'''
+
+        if self.share_hasher is None:
+            return defer.maybeDeferred(self.submit_share, job_id, worker_name, session, extranonce1_bin,
+                                       extranonce2, ntime, nonce, difficulty)
+
+        try:
+            share = self.prepare_share(job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
+                                       difficulty)
+        except Exception:
+            return defer.fail()
+
+        d = self.share_hasher.hash(share.header_swapped)
+        d.addErrback(_share_hashing_failed)
+        d.addCallback(lambda hash_bin: self.finish_share(share, hash_bin))
+        return d
+
+    def prepare_share(self, job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
+                      difficulty):
+        '''Check parameters, register the share and build its header.
+        Returns PendingShare, raises SubmitException for invalid shares.'''
+
+        debug = debug_enabled(log)
+        if debug:
+            log.debug("TemplateRegistry submit_share")
+            log.debug("from %s, (%s %s %s %s)", worker_name, LazyHex(extranonce1_bin), extranonce2, ntime, nonce)
         # Check if extranonce2 looks correctly. extranonce2 is in hex form...
         if len(extranonce2) != self.extranonce2_size * 2:
             raise SubmitException("Incorrect size of extranonce2. Expected %d chars" % (self.extranonce2_size * 2))
@@ -209,66 +385,90 @@ class TemplateRegistry(object):
         if len(nonce) != 8:
             raise SubmitException("Incorrect size of nonce. Expected 8 chars")
 
+        extranonce2_bin = binascii.unhexlify(extranonce2)
+        ntime_bin = binascii.unhexlify(ntime)
+        nonce_bin = binascii.unhexlify(nonce)
+
+        # Memory held by one job is limited
+        if not job.check_submits_limit():
+            raise SubmitException("Too many shares for job '%s'" % job_id)
+
         # Check for duplicated submit
-        if not job.register_submit(extranonce1_bin, extranonce2, ntime, nonce):
-            log.debug("Duplicate from %s, (%s %s %s %s)" % \
-                      (worker_name, binascii.hexlify(extranonce1_bin), extranonce2, ntime, nonce))
+        if not job.register_submit(extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin):
+            log.debug("Duplicate from %s, (%s %s %s %s)",
+                      worker_name, LazyHex(extranonce1_bin), extranonce2, ntime, nonce)
             raise SubmitException("Duplicate share")
 
         # Now let's do the hard work!
         # ---------------------------
 
-        # 0. Some sugar
-        extranonce2_bin = binascii.unhexlify(extranonce2)
-        ntime_bin = binascii.unhexlify(ntime)
-        nonce_bin = binascii.unhexlify(nonce)
-
-        # 1. Build coinbase
-        coinbase_bin = job.serialize_coinbase(extranonce1_bin, extranonce2_bin)
-        coinbase_hash = util.doublesha(coinbase_bin)
+        # 1. Hash coinbase
+        coinbase_hash = job.coinbase_hash(extranonce1_bin, extranonce2_bin)
 
         # 2. Calculate merkle root
         merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
-        merkle_root_int = util.uint256_from_str(merkle_root_bin)
         
-        log.debug("coinbase_hash: %s", coinbase_hash[::-1].encode("hex"))
+        if debug:
+            log.debug("coinbase_hash: %s", LazyHex(coinbase_hash[::-1]))
 
-        # 3. Serialize header with given merkle, ntime and nonce
-        header_bin = job.serialize_header(merkle_root_int, ntime_bin, nonce_bin)
-        
-        header_hex = header_bin.encode("hex")
-        log.debug("header_hex: %s", header_hex)
+        # 3. Serialize header with given merkle, ntime and nonce.
+        # Words are already swapped, so the header can be hashed directly
+        header_swapped = job.serialize_header_swapped(merkle_root_bin, ntime_bin, nonce_bin)
 
-        # 4. Reverse header and compare it with target of the user hash_bin = yac_scrypt.getPoWHash (''. join ([
-        # header_bin [i * 4: i * 4 +4] [:: -1] for i in range (0, 20)]), int (ntime, 16))
-        hash_bin = pyX11.x11_hash(''.join([header_bin[i * 4: i * 4 + 4][:: -1] for i in range(0, 20)]))
+        return PendingShare(job, job_id, session, difficulty, extranonce1_bin, extranonce2_bin,
+                            ntime, nonce, merkle_root_bin, header_swapped)
+
+    def finish_share(self, share, hash_bin):
+        '''Check x11 hash of the share header against targets. If the share
+        is a block candidate, the block is submitted to the network.
+
+        The job may have become stale while the share was hashed. Such
+        share is still credited (it was valid when submitted), but a block
+        candidate of a stale job is not submitted.'''
+
+        job = share.job
+        stale = job.prevhash_hex not in self.prevhashes
+        job_id = share.job_id
+        session = share.session
+        difficulty = share.difficulty
+        header_swapped = share.header_swapped
+
+        # 4. Compare hash with target of the user
         hash_int = util.uint256_from_str(hash_bin)
         x11_hash_hex = "%064x" % hash_int
-        header_hex = binascii.hexlify(header_bin)
+        header_hex = binascii.hexlify(util.swap_words(header_swapped))
+        log.debug("header_hex: %s", header_hex)
         header_hex = header_hex + "000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000"
 
-        target_user = self.diff_to_target(difficulty)
-        log.debug("hash_int: %064x, target_user: %064x" % (hash_int, target_user))
+        target_user = self.get_session_target(session, 'target', difficulty)
+        if debug_enabled(log):
+            log.debug("hash_int: %s, target_user: %s", LazyUint256(hash_int), LazyUint256(target_user))
         if hash_int > target_user and \
                 ('prev_jobid' not in session or session['prev_jobid'] < job_id
-                 or 'prev_diff' not in session or hash_int > self.diff_to_target(session['prev_diff'])):
+                 or 'prev_diff' not in session
+                 or hash_int > self.get_session_target(session, 'prev_target', session['prev_diff'])):
             raise SubmitException("Share is above target")
 
         # Mostly for debugging purposes
-        target_info = self.diff_to_target(100000)
-        if hash_int <= target_info:
+        if hash_int <= TARGET_INFO:
             log.debug("Yay, share with diff above 100000")
 
-        # Algebra tells us the diff_to_target is the same as hash_to_diff
-        share_diff = int(self.diff_to_target(hash_int))
+        # Algebra tells us the diff_to_target is the same as hash_to_diff.
+        # hash_int is long, so this is an exact integer division
+        share_diff = int(DIFF1 // hash_int)
 
         # 5. Compare hash with target of the network
-        if hash_int <= job.target:
+        if hash_int <= job.target and stale:
+            log.info("Block candidate %s of stale job %s, not submitting" % (x11_hash_hex, job_id))
+
+        elif hash_int <= job.target:
             # Yay! It is block candidate! 
-            log.debug("We found a block candidate! %s" % x11_hash_hex)
+            log.debug("We found a block candidate! %s", x11_hash_hex)
 
             # 6. Finalize and serialize block object 
-            job.finalize(merkle_root_int, extranonce1_bin, extranonce2_bin, int(ntime, 16), int(nonce, 16))
+            merkle_root_int = util.uint256_from_str(share.merkle_root_bin)
+            job.finalize(merkle_root_int, share.extranonce1_bin, share.extranonce2_bin,
+                         int(share.ntime, 16), int(share.nonce, 16))
 
             # if not job.is_valid():
             # Should not happen
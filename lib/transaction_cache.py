@@ -0,0 +1,57 @@
+import binascii
+
+import util
+import halfnode
+
+import lib.logger
+
+log = lib.logger.get_logger('transaction_cache')
+
+
+class TransactionCache(object):
+    """Keeps transactions of the last template keyed by txid.
+    Template refresh then decodes only transactions which were not
+    in the previous template. Transactions which left
+    the template are dropped, the whole cache is dropped when
+    the prevhash changes.
+
+    The merkle tree of the last template is kept too, so the next
+    tree hashes only nodes above changed transactions."""
+
+    def __init__(self):
+        self.prevhash = None
+        self.txs = {}
+        self.merkletree = None
+
+    def __len__(self):
+        return len(self.txs)
+
+    def _decode(self, tx):
+        txhash = int(tx['hash'], 16)
+        t = halfnode.CRawTransaction(binascii.unhexlify(tx['data']), txhash)
+        return (util.ser_uint256(txhash), t)
+
+    def update(self, prevhash, transactions):
+        """Returns (txhash_bin, CRawTransaction) for every
+        transaction of getblocktemplate result, in the same order."""
+        if prevhash != self.prevhash:
+            self.prevhash = prevhash
+            self.txs = {}
+            self.merkletree = None
+
+        old_txs = self.txs
+        self.txs = {}
+        entries = []
+        decoded = 0
+
+        for tx in transactions:
+            entry = old_txs.get(tx['hash'])
+            if entry is None:
+                entry = self._decode(tx)
+                decoded += 1
+            self.txs[tx['hash']] = entry
+            entries.append(entry)
+
+        log.debug("Transaction cache: %d txes, %d decoded, %d reused" % \
+                  (len(entries), decoded, len(entries) - decoded))
+        return entries
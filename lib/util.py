@@ -27,37 +27,32 @@ def ser_string(s):
     return chr(255) + struct.pack("<Q", len(s)) + s
 
 
+# uint256 codecs convert through a single hexlify/unhexlify call
+# instead of looping over 32-bit words, see _bench() below.
+# ser_uint256_be and uint256_from_str_be use words in little endian
+# order, every word in big endian.
+_UINT256_MASK = (1L << 256) - 1
+_uint256_words_le = struct.Struct("<8I")
+_uint256_words_be = struct.Struct(">8I")
+
+
 def deser_uint256(f):
-    r = 0L
-    for i in xrange(8):
-        v = f.read(4)
-        t = struct.unpack("<I", v)[0]
-        r += t << (i * 32)
-    return r
+    return uint256_from_str(f.read(32))
 
 
 def ser_uint256(u):
-    rs = ""
-    for i in xrange(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs
+    return binascii.unhexlify("%064x" % (u & _UINT256_MASK))[::-1]
 
 
 def uint256_from_str(s):
-    r = 0L
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in xrange(8):
-        r += t[i] << (i * 32)
-    return r
+    s = s[:32]
+    if len(s) != 32:
+        raise struct.error("uint256 requires a string argument of length 32")
+    return long(binascii.hexlify(s[::-1]), 16)
 
 
 def uint256_from_str_be(s):
-    r = 0L
-    t = struct.unpack(">IIIIIIII", s[:32])
-    for i in xrange(8):
-        r += t[i] << (i * 32)
-    return r
+    return uint256_from_str(_uint256_words_le.pack(*_uint256_words_be.unpack(s[:32])))
 
 
 def uint256_from_compact(c):
@@ -82,19 +77,20 @@ def deser_vector(f, c):
     return r
 
 
+def ser_compact_size(n):
+    if n < 253:
+        return chr(n)
+    elif n < 0x10000:
+        return chr(253) + struct.pack("<H", n)
+    elif n < 0x100000000L:
+        return chr(254) + struct.pack("<I", n)
+    return chr(255) + struct.pack("<Q", n)
+
+
 def ser_vector(l):
-    r = ""
-    if len(l) < 253:
-        r = chr(len(l))
-    elif len(l) < 0x10000:
-        r = chr(253) + struct.pack("<H", len(l))
-    elif len(l) < 0x100000000L:
-        r = chr(254) + struct.pack("<I", len(l))
-    else:
-        r = chr(255) + struct.pack("<Q", len(l))
-    for i in l:
-        r += i.serialize()
-    return r
+    r = [ser_compact_size(len(l))]
+    r.extend([i.serialize() for i in l])
+    return ''.join(r)
 
 
 def deser_uint256_vector(f):
@@ -208,19 +204,17 @@ def address_to_pubkeyhash(addr):
 
 def ser_uint256_be(u):
     '''ser_uint256 to big endian'''
-    rs = ""
-    for i in xrange(8):
-        rs += struct.pack(">I", u & 0xFFFFFFFFL)
-        u >>= 32
-    return rs
+    return _uint256_words_be.pack(*_uint256_words_le.unpack(ser_uint256(u)))
+
+
+def swap_words(s):
+    """Reverse byte order of every 4-byte word of s"""
+    n = len(s) // 4
+    return struct.pack(">%dI" % n, *struct.unpack("<%dI" % n, s))
 
 
 def deser_uint256_be(f):
-    r = 0L
-    for i in xrange(8):
-        t = struct.unpack(">I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return uint256_from_str_be(f.read(32))
 
 
 def ser_number(n):
@@ -256,8 +250,72 @@ def _test():
 
 def _test2():
     print(ser_number(0x01020304).encode("hex"))
-    
+
+
+def _bench(count=100000):
+    """Compare uint256 codecs with the original word by word loops"""
+    import os
+    import timeit
+
+    def ref_ser_uint256(u):
+        rs = ""
+        for i in xrange(8):
+            rs += struct.pack("<I", u & 0xFFFFFFFFL)
+            u >>= 32
+        return rs
+
+    def ref_ser_uint256_be(u):
+        rs = ""
+        for i in xrange(8):
+            rs += struct.pack(">I", u & 0xFFFFFFFFL)
+            u >>= 32
+        return rs
+
+    def ref_uint256_from_str(s):
+        r = 0L
+        t = struct.unpack("<IIIIIIII", s[:32])
+        for i in xrange(8):
+            r += t[i] << (i * 32)
+        return r
+
+    def ref_uint256_from_str_be(s):
+        r = 0L
+        t = struct.unpack(">IIIIIIII", s[:32])
+        for i in xrange(8):
+            r += t[i] << (i * 32)
+        return r
+
+    for _ in xrange(1000):
+        s = os.urandom(32)
+        u = ref_uint256_from_str(s)
+        assert uint256_from_str(s) == u
+        assert uint256_from_str_be(s) == ref_uint256_from_str_be(s)
+        assert ser_uint256(u) == ref_ser_uint256(u) == s
+        assert ser_uint256_be(u) == ref_ser_uint256_be(u)
+        assert ser_uint256(-u) == ref_ser_uint256(-u)
+        assert ser_uint256(u << 40) == ref_ser_uint256(u << 40)
+
+    s = os.urandom(32)
+    u = uint256_from_str(s)
+    cases = [
+        ('ser_uint256', ref_ser_uint256, ser_uint256, u),
+        ('ser_uint256_be', ref_ser_uint256_be, ser_uint256_be, u),
+        ('uint256_from_str', ref_uint256_from_str, uint256_from_str, s),
+        ('uint256_from_str_be', ref_uint256_from_str_be, uint256_from_str_be, s),
+    ]
+    for (name, ref, fast, arg) in cases:
+        t_ref = timeit.timeit(lambda: ref(arg), number=count) / count
+        t_fast = timeit.timeit(lambda: fast(arg), number=count) / count
+        print "%-20s %6.2f us -> %6.2f us" % (name, t_ref * 1e6, t_fast * 1e6)
+
+    # Share validation decodes the hash and, for block candidates,
+    # the merkle root; every template transaction hash is encoded once
+    t_ref = timeit.timeit(lambda: (ref_uint256_from_str(s), ref_uint256_from_str(s)), number=count) / count
+    t_fast = timeit.timeit(lambda: (uint256_from_str(s), uint256_from_str(s)), number=count) / count
+    print "%-20s %6.2f us -> %6.2f us" % ('per share', t_ref * 1e6, t_fast * 1e6)
+
 
 if __name__ == '__main__':
     # _test()
     _test2()
+    _bench()
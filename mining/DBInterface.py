@@ -1,4 +1,5 @@
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool, failure
 import time
 from datetime import datetime
 import Queue
@@ -8,15 +9,31 @@ import lib.settings as settings
 
 import lib.logger
 
+import DB_Pool
+
 log = lib.logger.get_logger('DBInterface')
 
 
 class DBInterface():
     def __init__(self):
-        self.dbi = self.connectDB()
+        # Handles are shared by the reactor and the import threads
+        self.pool = DB_Pool.DB_Pool(self.connectDB)
+
+        # Threads running the blocking queries, see run_async()
+        self.threadpool = threadpool.ThreadPool(1, settings.DB_THREAD_POOL_SIZE, 'DBInterface')
+        reactor.callWhenRunning(self.threadpool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+
+        # Password lookups running in the thread pool, by wid.
+        # Callers asking for the same worker wait for the running lookup.
+        self.password_lookups = {}
+
+        # Write-behind buffer of worker difficulties, only the latest one is kept
+        self.worker_diffs = {}
+        self.worker_diff_clock = None
 
     def init_main(self):
-        self.dbi.check_tables()
+        self.pool.call('check_tables')
 
         self.q = Queue.Queue()
         self.queueclock = None
@@ -27,6 +44,7 @@ class DBInterface():
         self.nextStatsUpdate = 0
 
         self.scheduleImport()
+        self.scheduleWorkerDiffFlush()
 
         self.next_force_import_time = time.time() + settings.DB_LOADER_FORCE_TIME
 
@@ -34,7 +52,14 @@ class DBInterface():
 
     def signal_handler(self, signal, frame):
         print "SIGINT Detected, shutting down"
-        self.do_import(self.dbi, True)
+        try:
+            self.pool.run(self.do_import, True)
+        except Exception as e:
+            log.error("Final import failed: %s", e)
+        try:
+            self.flush_worker_diffs(self.take_worker_diffs())
+        except Exception as e:
+            log.error("Final worker difficulty flush failed: %s", e)
         reactor.stop()
 
     def set_bitcoinrpc(self, bitcoinrpc):
@@ -68,27 +93,30 @@ class DBInterface():
         log.debug("run_import_thread current size: %d", self.q.qsize())
 
         if self.q.qsize() >= settings.DB_LOADER_REC_MIN or time.time() >= self.next_force_import_time:  # Don't incur thread overhead if we're not going to run
-            reactor.callInThread(self.import_thread)
+            self.run_async(self.import_thread)
 
         self.scheduleImport()
 
     def run_import(self):
         log.debug("DBInterface.run_import called")
 
-        self.do_import(self.dbi, False)
+        try:
+            self.pool.run(self.do_import, False)
+        except Exception as e:
+            log.error("Import failed: %s", e)
 
         self.scheduleImport()
 
     def import_thread(self):
         # Here we are in the thread.
-        dbi = self.connectDB()
-        self.do_import(dbi, False)
-
-        dbi.close()
+        try:
+            self.pool.run(self.do_import, False)
+        except Exception as e:
+            log.error("Import thread failed: %s", e)
 
     def _update_pool_info(self, data):
-        self.dbi.update_pool_info({'blocks': data['blocks'], 'balance': data['balance'],
-                                   'connections': data['connections'], 'difficulty': data['difficulty']})
+        self.pool.call('update_pool_info', {'blocks': data['blocks'], 'balance': data['balance'],
+                                            'connections': data['connections'], 'difficulty': data['difficulty']})
 
     def do_import(self, dbi, force):
         log.debug("DBInterface.do_import called. force: %s, queue size: %s", 'yes' if force == True else 'no',
@@ -119,17 +147,53 @@ class DBInterface():
                     self.q.put(v)
                 break  # Allows us to sleep a little
 
+    def run_async(self, func, *args, **kwargs):
+        '''Runs func in the DB thread pool, so the reactor
+        never waits for MySQL. Returns Deferred with its result.'''
+        return threads.deferToThreadPool(reactor, self.threadpool, func, *args, **kwargs)
+
     def queue_share(self, data):
         self.q.put(data)
 
     def found_block(self, data):
         try:
             log.info("Updating Found Block Share Record")
-            self.do_import(self.dbi, True)  # We can't Update if the record is not there.
-            self.dbi.found_block(data)
+            self.pool.run(self._found_block, data)
         except Exception as e:
             log.error("Update Found Block Share Record Failed: %s", e.args[0])
 
+    def _found_block(self, dbi, data):
+        self.do_import(dbi, True)  # We can't Update if the record is not there.
+        dbi.found_block(data)
+
+    def found_block_async(self, data):
+        return self.run_async(self.found_block, data)
+
+    def check_password_async(self, username, password):
+        '''Deferred version of check_password(), cached
+        workers are answered without touching the thread pool.
+        Concurrent calls for one worker share a single lookup.'''
+        wid = str(username) + ":-:" + str(password)
+        if username != "" and wid in self.usercache:
+            return defer.succeed(True)
+
+        waiters = self.password_lookups.get(wid)
+        if waiters is None:
+            waiters = self.password_lookups[wid] = []
+            d = self.run_async(self.check_password, username, password)
+            d.addBoth(self._password_lookup_done, wid)
+
+        waiter = defer.Deferred()
+        waiters.append(waiter)
+        return waiter
+
+    def _password_lookup_done(self, result, wid):
+        for waiter in self.password_lookups.pop(wid):
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
     def check_password(self, username, password):
         if username == "":
             log.info("Rejected worker for blank username")
@@ -145,7 +209,7 @@ class DBInterface():
         elif not settings.USERS_CHECK_PASSWORD and self.user_exists(username):
             self.usercache[wid] = 1
             return True
-        elif self.dbi.check_password(username, password):
+        elif self.pool.call('check_password', username, password):
             self.usercache[wid] = 1
             return True
         elif settings.USERS_AUTOADD == True:
@@ -157,34 +221,67 @@ class DBInterface():
         return False
 
     def list_users(self):
-        return self.dbi.list_users()
+        return self.pool.run(lambda dbi: list(dbi.list_users()))
 
     def get_user(self, id):
-        return self.dbi.get_user(id)
+        return self.pool.call('get_user', id)
 
     def user_exists(self, username):
-        user = self.dbi.get_user(username)
+        user = self.pool.call('get_user', username)
         return user is not None
 
     def insert_user(self, username, password):
-        return self.dbi.insert_user(username, password)
+        return self.pool.call('insert_user', username, password)
 
     def delete_user(self, username):
         self.usercache = {}
-        return self.dbi.delete_user(username)
+        return self.pool.call('delete_user', username)
 
     def update_user(self, username, password):
         self.usercache = {}
-        return self.dbi.update_user(username, password)
+        return self.pool.call('update_user', username, password)
 
     def update_worker_diff(self, username, diff):
-        return self.dbi.update_worker_diff(username, diff)
+        return self.pool.call('update_worker_diff', username, diff)
+
+    def queue_worker_diff(self, username, diff):
+        '''Buffers the difficulty of the worker, the buffer
+        is written to the DB every DB_WORKER_DIFF_FLUSH_TIME.'''
+        self.worker_diffs[username] = diff
+
+    def scheduleWorkerDiffFlush(self):
+        self.worker_diff_clock = reactor.callLater(settings.DB_WORKER_DIFF_FLUSH_TIME, self.run_worker_diff_flush)
+
+    def take_worker_diffs(self):
+        diffs = self.worker_diffs
+        self.worker_diffs = {}
+        return diffs
+
+    def run_worker_diff_flush(self):
+        diffs = self.take_worker_diffs()
+        if diffs:
+            log.debug("Flushing difficulty of %d workers", len(diffs))
+            d = self.run_async(self.flush_worker_diffs, diffs)
+            d.addErrback(self._flush_worker_diffs_failed, diffs)
+
+        self.scheduleWorkerDiffFlush()
+
+    def flush_worker_diffs(self, diffs):
+        if diffs:
+            self.pool.call('update_worker_diffs', diffs)
+
+    def _flush_worker_diffs_failed(self, failure, diffs):
+        log.error("Update of %d worker difficulties failed: %s", len(diffs), failure.getErrorMessage())
+        # Put them back unless a newer difficulty arrived in the meantime
+        for username, diff in diffs.iteritems():
+            self.worker_diffs.setdefault(username, diff)
 
     def get_pool_stats(self):
-        return self.dbi.get_pool_stats()
+        return self.pool.call('get_pool_stats')
 
     def get_workers_stats(self):
-        return self.dbi.get_workers_stats()
+        return self.pool.call('get_workers_stats')
 
     def clear_worker_diff(self):
-        return self.dbi.clear_worker_diff()
+        self.worker_diffs = {}
+        return self.pool.call('clear_worker_diff')
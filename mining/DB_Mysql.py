@@ -55,6 +55,35 @@ class DB_Mysql():
 
             self.dbc.executemany(query, args)
 
+    def bulk_insert(self, query, row_template, rows):
+        """Insert all rows in one transaction using multi-row
+        INSERT statements of at most DB_LOADER_CHUNK_SIZE rows.
+        Nothing is stored when any of the chunks fails."""
+        if not rows:
+            return
+
+        chunk_size = max(1, settings.DB_LOADER_CHUNK_SIZE)
+
+        try:
+            self.dbh.ping(False)
+        except pymysql.Error:
+            log.debug("MySQL connection lost before bulk insert, attempting reconnect")
+            self.connect()
+
+        self.dbh.begin()
+        try:
+            for i in xrange(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                args = [arg for row in chunk for arg in row]
+                self.dbc.execute(query + ",".join([row_template] * len(chunk)), args)
+            self.dbh.commit()
+        except:
+            try:
+                self.dbh.rollback()
+            except pymysql.Error:
+                pass
+            raise
+
     def import_shares(self, data):
         # Data layout
         # 0: worker_name, 
@@ -70,38 +99,21 @@ class DB_Mysql():
         # 10: share_diff
 
         log.debug("Importing Shares")
-        checkin_times = {}
-        total_shares = 0
-        best_diff = 0
-
-        for k, v in enumerate(data):
-            # for database compatibility we are converting our_worker to Y/N format
-            if v[5]:
-                v[5] = 'Y'
-            else:
-                v[5] = 'N'
-
-            self.execute(
-                """
-                INSERT INTO `shares`
-                (time, rem_host, username, our_result, 
-                  upstream_result, reason, solution)
-                VALUES 
-                (FROM_UNIXTIME(%(time)s), %(host)s, 
-                  %(uname)s, 
-                  %(lres)s, 'N', %(reason)s, %(solution)s)
-                """,
-                {
-                    "time": v[4],
-                    "host": v[6],
-                    "uname": v[0],
-                    "lres": v[5],
-                    "reason": v[9],
-                    "solution": v[2]
-                }
-            )
 
-            self.dbh.commit()
+        # for database compatibility we are converting our_worker to Y/N format,
+        # the original records are kept untouched in case they go back to the queue
+        rows = [(v[4], v[6], v[0], 'Y' if v[5] else 'N', v[9], v[2]) for v in data]
+
+        self.bulk_insert(
+            """
+            INSERT INTO `shares`
+            (time, rem_host, username, our_result, 
+              upstream_result, reason, solution)
+            VALUES 
+            """,
+            "(FROM_UNIXTIME(%s), %s, %s, %s, 'N', %s, %s)",
+            rows
+        )
 
     def found_block(self, data):
         # for database compatibility we are converting our_worker to Y/N format
@@ -285,6 +297,13 @@ class DB_Mysql():
 
         return ret
 
+    def ping(self):
+        try:
+            self.dbh.ping(False)
+        except pymysql.Error:
+            return False
+        return True
+
     def close(self):
         self.dbh.close()
 
@@ -28,39 +28,21 @@ class DB_Mysql_Vardiff(DB_Mysql.DB_Mysql):
         # 10: share_diff
 
         log.debug("Importing Shares")
-        checkin_times = {}
-        total_shares = 0
-        best_diff = 0
 
-        for k, v in enumerate(data):
-            # for database compatibility we are converting our_worker to Y/N format
-            if v[5]:
-                v[5] = 'Y'
-            else:
-                v[5] = 'N'
+        # for database compatibility we are converting our_worker to Y/N format,
+        # the original records are kept untouched in case they go back to the queue
+        rows = [(v[4], v[6], v[0], 'Y' if v[5] else 'N', v[9], v[2], v[3]) for v in data]
 
-            self.execute(
-                """
-                INSERT INTO `shares`
-                (time, rem_host, username, our_result, 
-                  upstream_result, reason, solution, difficulty)
-                VALUES 
-                (FROM_UNIXTIME(%(time)s), %(host)s, 
-                  %(uname)s, 
-                  %(lres)s, 'N', %(reason)s, %(solution)s, %(difficulty)s)
-                """,
-                {
-                    "time": v[4],
-                    "host": v[6],
-                    "uname": v[0],
-                    "lres": v[5],
-                    "reason": v[9],
-                    "solution": v[2],
-                    "difficulty": v[3]
-                }
-            )
-
-            self.dbh.commit()
+        self.bulk_insert(
+            """
+            INSERT INTO `shares`
+            (time, rem_host, username, our_result, 
+              upstream_result, reason, solution, difficulty)
+            VALUES 
+            """,
+            "(FROM_UNIXTIME(%s), %s, %s, %s, 'N', %s, %s, %s)",
+            rows
+        )
 
     def update_worker_diff(self, username, diff):
         log.debug("Setting difficulty for %s to %s", username, diff)
@@ -79,6 +61,27 @@ class DB_Mysql_Vardiff(DB_Mysql.DB_Mysql):
 
         self.dbh.commit()
 
+    def update_worker_diffs(self, diffs):
+        log.debug("Setting difficulty for %d workers", len(diffs))
+
+        chunk_size = max(1, settings.DB_LOADER_CHUNK_SIZE)
+        items = diffs.items()
+
+        for i in xrange(0, len(items), chunk_size):
+            chunk = items[i:i + chunk_size]
+            args = [arg for item in chunk for arg in item] + [username for (username, _) in chunk]
+
+            self.execute(
+                """
+                UPDATE `pool_worker`
+                SET `difficulty` = CASE `username` %s END
+                WHERE `username` IN (%s)
+                """ % (" ".join(["WHEN %s THEN %s"] * len(chunk)), ", ".join(["%s"] * len(chunk))),
+                args
+            )
+
+            self.dbh.commit()
+
     def clear_worker_diff(self):
         log.debug("Resetting difficulty for all workers")
 
@@ -0,0 +1,173 @@
+import time
+import threading
+
+import lib.settings as settings
+import lib.logger
+
+log = lib.logger.get_logger('DB_Pool')
+
+import pymysql
+
+
+class DB_Pool():
+    """Bounded, thread-safe pool of database handles.
+
+    Handles are created lazily by the given factory (e.g. DB_Mysql)
+    up to max_size. A handle which was idle longer than max_idle seconds
+    is closed instead of being reused, a handle idle longer than
+    ping_interval seconds is pinged before it is lent.
+
+    When a connection attempt fails, further attempts are refused
+    until the backoff expires. The backoff doubles on every failure
+    (from backoff_min up to backoff_max) and resets on success."""
+
+    def __init__(self, factory, max_size=None, max_idle=None, ping_interval=None,
+                 timeout=None, backoff_min=None, backoff_max=None):
+        self.factory = factory
+        self.max_size = max(1, max_size or settings.DB_POOL_SIZE)
+        self.max_idle = max_idle or settings.DB_POOL_MAX_IDLE
+        self.ping_interval = ping_interval or settings.DB_POOL_PING_INTERVAL
+        self.timeout = timeout or settings.DB_POOL_TIMEOUT
+        self.backoff_min = backoff_min or settings.DB_POOL_BACKOFF_MIN
+        self.backoff_max = backoff_max or settings.DB_POOL_BACKOFF_MAX
+
+        self.lock = threading.Condition()
+        self.idle = []  # List of (dbi, returned_at), most recently used last
+        self.size = 0  # Handles created and not closed yet (idle + lent)
+
+        self.backoff = 0
+        self.next_connect_time = 0
+
+    def _connect(self):
+        # A slot in self.size is already reserved by the caller
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now < self.next_connect_time:
+                raise Exception("Database unavailable, next connection attempt in %.1f sec" % \
+                                (self.next_connect_time - now))
+        finally:
+            self.lock.release()
+
+        try:
+            dbi = self.factory()
+        except Exception:
+            self.lock.acquire()
+            try:
+                self.backoff = min(self.backoff_max, max(self.backoff_min, self.backoff * 2))
+                self.next_connect_time = time.time() + self.backoff
+                log.error("Database connection failed, retrying in %.1f sec" % self.backoff)
+            finally:
+                self.lock.release()
+            raise
+
+        self.lock.acquire()
+        try:
+            self.backoff = 0
+            self.next_connect_time = 0
+        finally:
+            self.lock.release()
+        return dbi
+
+    def _discard(self, dbi):
+        try:
+            dbi.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self, now):
+        # Called with self.lock held, the oldest handles are at the beginning
+        while self.idle and now - self.idle[0][1] > self.max_idle:
+            (dbi, returned_at) = self.idle.pop(0)
+            self.size -= 1
+            log.debug("Closing DB connection idle for %d sec" % (now - returned_at))
+            self._discard(dbi)
+
+    def _take(self):
+        # Returns an idle handle, None when a new one may be created
+        deadline = time.time() + self.timeout
+
+        self.lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                self._evict_idle(now)
+
+                if self.idle:
+                    return self.idle.pop()
+
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None
+
+                if now >= deadline:
+                    raise Exception("No free DB connection in %d sec (pool size %d)" % \
+                                    (self.timeout, self.max_size))
+                self.lock.wait(deadline - now)
+        finally:
+            self.lock.release()
+
+    def get(self):
+        """Borrow a handle. Blocks at most self.timeout seconds
+        when all handles are lent."""
+        while True:
+            idle = self._take()
+
+            if idle is None:
+                try:
+                    return self._connect()
+                except:
+                    self.put(None, True)
+                    raise
+
+            (dbi, returned_at) = idle
+            if time.time() - returned_at <= self.ping_interval or dbi.ping():
+                return dbi
+
+            log.debug("Dropping dead DB connection")
+            self.put(dbi, True)
+
+    def put(self, dbi, broken=False):
+        """Return a borrowed handle, broken handles are closed."""
+        self.lock.acquire()
+        try:
+            if broken:
+                self.size -= 1
+                if dbi is not None:
+                    self._discard(dbi)
+            else:
+                self.idle.append((dbi, time.time()))
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def run(self, func, *args, **kwargs):
+        """Borrow a handle, call func(dbi, *args, **kwargs)
+        and give the handle back to the pool."""
+        dbi = self.get()
+        try:
+            result = func(dbi, *args, **kwargs)
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            self.put(dbi, True)
+            raise
+        except:
+            self.put(dbi)
+            raise
+
+        self.put(dbi)
+        return result
+
+    def call(self, method, *args, **kwargs):
+        """Call the given method of a pooled handle"""
+        return self.run(lambda dbi: getattr(dbi, method)(*args, **kwargs))
+
+    def close(self):
+        """Close all idle handles"""
+        self.lock.acquire()
+        try:
+            for (dbi, _) in self.idle:
+                self.size -= 1
+                self._discard(dbi)
+            self.idle = []
+        finally:
+            self.lock.release()
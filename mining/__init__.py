@@ -1,8 +1,8 @@
 from service import MiningService
 from subscription import MiningSubscription
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet.error import ConnectionRefusedError
-import time
+from twisted.web import error as web_error
 import simplejson as json
 from twisted.internet import reactor
 
@@ -23,7 +23,7 @@ def setup(on_startup):
 
     from interfaces import Interfaces
 
-    from lib.block_updater import BlockUpdater
+    from lib.block_updater import BlockUpdater, LongPollListener
     from lib.template_registry import TemplateRegistry
     from lib.bitcoin_rpc_manager import BitcoinRPCManager
     from lib.block_template import BlockTemplate
@@ -50,7 +50,11 @@ def setup(on_startup):
                 "Connection refused while trying to connect to dashcoin (are your DASHCOIN_TRUSTED_* settings correct?)")
             reactor.stop()
 
-        except Exception, e:
+        except defer.TimeoutError, e:
+            log.error("%s, retrying" % e)
+
+        except web_error.Error, e:
+            # HTTP error of a running Dashcoind, the body holds the RPC error
             if isinstance(e[2], str):
                 if isinstance(json.loads(e[2])['error']['message'], str):
                     error = json.loads(e[2])['error']['message']
@@ -59,10 +63,15 @@ def setup(on_startup):
                         reactor.stop()
                     elif error == "Dashcoind is downloading blocks...":
                         log.error("Dashcoind downloading blockchain... will check back in 30 sec")
-                        time.sleep(29)
+                        yield task.deferLater(reactor, 29, lambda: None)
                     else:
                         log.error("Dashcoind Error: %s", error)
-        time.sleep(1)  # If we didn't get a result or the connect failed
+
+        except Exception, e:
+            log.error("Cannot connect to Dashcoind, retrying: %s" % e)
+
+        # If we didn't get a result or the connect failed
+        yield task.deferLater(reactor, 1, lambda: None)
 
     log.info('Connected to Dashcoind - Ready to GO!')
 
@@ -77,6 +86,27 @@ def setup(on_startup):
                                 MiningSubscription.on_template,  # on template callback
                                 Interfaces.share_manager.on_network_block)  # on block callback
 
+    # Share hashing outside of the reactor thread and/or in batches
+    from lib.share_validator import ShareHasher, ThreadShareHasher, BatchingShareHasher
+    share_hasher = None
+    if settings.SHARE_WORKER_PROCESSES > 0:
+        share_hasher = ShareHasher(settings.SHARE_WORKER_PROCESSES, settings.SHARE_WORKER_QUEUE_MAX,
+                                   settings.SHARE_WORKER_TIMEOUT)
+    elif settings.SHARE_WORKER_THREADS > 0:
+        share_hasher = ThreadShareHasher(settings.SHARE_WORKER_THREADS, settings.SHARE_WORKER_QUEUE_MAX,
+                                         settings.SHARE_WORKER_TIMEOUT)
+
+    if settings.SHARE_BATCH_WINDOW > 0 and share_hasher is None:
+        # Batches would only delay shares hashed in the reactor thread anyway
+        log.warning("SHARE_BATCH_WINDOW needs SHARE_WORKER_PROCESSES or SHARE_WORKER_THREADS, batching disabled")
+    elif settings.SHARE_BATCH_WINDOW > 0:
+        share_hasher = BatchingShareHasher(share_hasher, settings.SHARE_BATCH_WINDOW, settings.SHARE_BATCH_MAX,
+                                           settings.SHARE_BATCH_STATS_INTERVAL)
+
+    if share_hasher is not None:
+        registry.share_hasher = share_hasher
+        reactor.addSystemEventTrigger('before', 'shutdown', share_hasher.close)
+
     # Template registry is the main interface between Stratum service
     # and pool core logic
     Interfaces.set_template_registry(registry)
@@ -84,7 +114,13 @@ def setup(on_startup):
     # Set up polling mechanism for detecting new block on the network
     # This is just failsafe solution when -blocknotify
     # mechanism is not working properly    
-    BlockUpdater(registry, bitcoin_rpc)
+    updater = BlockUpdater(registry, bitcoin_rpc)
+
+    # Dashcoind pushes new blocks to a waiting getblocktemplate long poll
+    if settings.LONGPOLL_ENABLED:
+        listener = LongPollListener(registry, bitcoin_rpc, updater)
+        listener.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', listener.stop)
 
     log.info("MINING SERVICE IS READY")
     on_startup.callback(True)
@@ -4,9 +4,9 @@ import lib.logger
 
 log = lib.logger.get_logger('BasicShareLimiter')
 
-import DBInterface
+# Share the DB interface (and its connection pool) with the rest of the pool
+from mining.interfaces import dbi
 
-dbi = DBInterface.DBInterface()
 dbi.clear_worker_diff()
 
 from twisted.internet import defer
@@ -104,7 +104,7 @@ class BasicShareLimiter(object):
             'last_ts'] < ts - settings.DB_USERCACHE_TIME:
             self.worker_stats[worker_name] = {'last_rtc': (ts - self.retarget / 2), 'last_ts': ts,
                                               'buffer': SpeedBuffer(self.buffersize)}
-            dbi.update_worker_diff(worker_name, settings.POOL_TARGET)
+            dbi.queue_worker_diff(worker_name, settings.POOL_TARGET)
             return
 
         # Standard share update of data
@@ -162,4 +162,4 @@ class BasicShareLimiter(object):
         session['prev_jobid'] = job_id
         session['difficulty'] = new_diff
         connection_ref().rpc('mining.set_difficulty', [new_diff, ], is_notification=True)
-        dbi.update_worker_diff(worker_name, new_diff)
+        dbi.queue_worker_diff(worker_name, new_diff)
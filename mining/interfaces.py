@@ -25,7 +25,8 @@ class WorkerManagerInterface(object):
 
     def authorize(self, worker_name, worker_password):
         # Important NOTE: This is called on EVERY submitted share. So you'll need caching!!!
-        return dbi.check_password(worker_name, worker_password)
+        # Returns Deferred, cache misses are checked in the DB thread pool.
+        return dbi.check_password_async(worker_name, worker_password)
 
 
 class ShareLimiterInterface(object):
@@ -62,7 +63,7 @@ class ShareManagerInterface(object):
 
     def on_submit_block(self, is_accepted, worker_name, block_header, block_hash, timestamp, ip, share_diff):
         log.info("Block %s %s" % (block_hash, 'ACCEPTED' if is_accepted else 'REJECTED'))
-        dbi.found_block(
+        dbi.found_block_async(
             [worker_name, block_header, block_hash, -1, timestamp, is_accepted, ip, self.block_height, self.prev_hash,
              share_diff])
 
@@ -31,7 +31,7 @@ class MiningService(GenericService):
         See blocknotify.sh in /scripts/ for more info.'''
 
         log.info("New block notification received")
-        Interfaces.template_registry.update_block()
+        Interfaces.template_registry.update_block(new_block=True)
         return True
 
     @admin
@@ -51,13 +51,9 @@ class MiningService(GenericService):
         session = self.connection_ref().get_session()
         session.setdefault('authorized', {})
 
-        if Interfaces.worker_manager.authorize(worker_name, worker_password):
-            session['authorized'][worker_name] = worker_password
-            return True
-        else:
-            if worker_name in session['authorized']:
-                del session['authorized'][worker_name]
-            return False
+        d = defer.maybeDeferred(Interfaces.worker_manager.authorize, worker_name, worker_password)
+        d.addCallback(_on_authorize, session, worker_name, worker_password)
+        return d
 
     def subscribe(self, *args):
         '''Subscribe for receiving mining jobs. This will
@@ -80,47 +76,10 @@ class MiningService(GenericService):
         session.setdefault('authorized', {})
 
         # Check if worker is authorized to submit shares
-        if not Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name)):
-            raise SubmitException("Worker is not authorized")
-
-        # Check if extranonce1 is in connection session
-        extranonce1_bin = session.get('extranonce1', None)
-
-        if not extranonce1_bin:
-            raise SubmitException("Connection is not subscribed for mining")
-
-        difficulty = session['difficulty']
-        submit_time = Interfaces.timestamper.time()
-        ip = self.connection_ref()._get_ip()
-
-        Interfaces.share_limiter.submit(self.connection_ref, job_id, difficulty, submit_time, worker_name)
-
-        # This checks if submitted share meet all requirements
-        # and it is valid proof of work.
-        try:
-            block_header, block_hash, share_diff, on_submit = Interfaces.template_registry.submit_share(job_id,
-                                                                                                        worker_name,
-                                                                                                        session,
-                                                                                                        extranonce1_bin,
-                                                                                                        extranonce2,
-                                                                                                        ntime, nonce,
-                                                                                                        difficulty)
-        except SubmitException as e:
-            log.error("SubmitException %s", str(e))
-            # block_header and block_hash are None when submitted data are corrupted
-            Interfaces.share_manager.on_submit_share(worker_name, False, False, difficulty,
-                                                     submit_time, False, ip, e[0], 0)
-            raise
-
-        Interfaces.share_manager.on_submit_share(worker_name, block_header,
-                                                 block_hash, difficulty, submit_time, True, ip, '', share_diff)
-        if on_submit is not None:
-            # Pool performs submitblock() to Dashcoind. Let's hook
-            # to result and report it to share manager
-            on_submit.addCallback(Interfaces.share_manager.on_submit_block,
-                                  worker_name, block_header, block_hash, submit_time, ip, share_diff)
-
-        return True
+        d = defer.maybeDeferred(Interfaces.worker_manager.authorize, worker_name,
+                                session['authorized'].get(worker_name))
+        d.addCallback(_submit_authorized, self.connection_ref, session, worker_name, job_id, extranonce2, ntime, nonce)
+        return d
 
     # Service documentation for remote discovery
     update_block.help_text = "Notify Stratum server about new block on the network."
@@ -144,3 +103,76 @@ class MiningService(GenericService):
                      ('ntime', 'string',
                       'UNIX timestamp (32bit integer, big-endian, hex-encoded), must be >= ntime provided by mining,notify and <= current time'),
                      ('nonce', 'string', '32bit integer, hex-encoded, big-endian'), ]
+
+
+# Callbacks of MiningService are kept outside of the class,
+# because every method of the service is exposed over Stratum.
+
+def _on_authorize(is_authorized, session, worker_name, worker_password):
+    if is_authorized:
+        session['authorized'][worker_name] = worker_password
+        return True
+    else:
+        if worker_name in session['authorized']:
+            del session['authorized'][worker_name]
+        return False
+
+
+def _submit_authorized(is_authorized, connection_ref, session, worker_name, job_id, extranonce2, ntime, nonce):
+    if not is_authorized:
+        raise SubmitException("Worker is not authorized")
+
+    # Check if extranonce1 is in connection session
+    extranonce1_bin = session.get('extranonce1', None)
+
+    if not extranonce1_bin:
+        raise SubmitException("Connection is not subscribed for mining")
+
+    connection = connection_ref()
+    if connection is None:
+        # Connection has been closed while the worker was authorized
+        return False
+
+    difficulty = session['difficulty']
+    submit_time = Interfaces.timestamper.time()
+    ip = connection._get_ip()
+
+    Interfaces.share_limiter.submit(connection_ref, job_id, difficulty, submit_time, worker_name)
+
+    registry = Interfaces.template_registry
+    if registry.share_hasher is not None:
+        # Stop reading from clients when worker processes are overloaded
+        registry.share_hasher.throttle(connection.transport)
+
+    # This checks if submitted share meet all requirements
+    # and it is valid proof of work.
+    d = registry.submit_share_deferred(job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
+                                       difficulty)
+    d.addCallbacks(_on_share_valid, _on_share_invalid,
+                   callbackArgs=(worker_name, difficulty, submit_time, ip),
+                   errbackArgs=(worker_name, difficulty, submit_time, ip))
+    return d
+
+
+def _on_share_invalid(failure, worker_name, difficulty, submit_time, ip):
+    failure.trap(SubmitException)
+    e = failure.value
+    log.error("SubmitException %s", e)
+    # block_header and block_hash are None when submitted data are corrupted
+    Interfaces.share_manager.on_submit_share(worker_name, False, False, difficulty,
+                                             submit_time, False, ip, e[0], 0)
+    return failure
+
+
+def _on_share_valid(result, worker_name, difficulty, submit_time, ip):
+    (block_header, block_hash, share_diff, on_submit) = result
+
+    Interfaces.share_manager.on_submit_share(worker_name, block_header,
+                                             block_hash, difficulty, submit_time, True, ip, '', share_diff)
+    if on_submit is not None:
+        # Pool performs submitblock() to Dashcoind. Let's hook
+        # to result and report it to share manager
+        on_submit.addCallback(Interfaces.share_manager.on_submit_block,
+                              worker_name, block_header, block_hash, submit_time, ip, share_diff)
+
+    return True
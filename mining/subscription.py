@@ -1,3 +1,4 @@
+from twisted.internet import task
 from stratum.pubsub import Pubsub, Subscription
 from mining.interfaces import Interfaces
 
@@ -7,6 +8,96 @@ import lib.logger
 log = lib.logger.get_logger('subscription')
 
 
+class NotifyBroadcaster(object):
+    """Sends the last template to all subscribers of mining.notify.
+
+    With chunk > 0 only that many connections are served per reactor
+    iteration, so submits and other I/O are handled during a long
+    broadcast. A block change (clean_jobs) stops any running broadcast.
+    A merkle refresh replaces a running refresh, but waits until
+    a running block change broadcast is finished."""
+
+    def __init__(self):
+        # Every tick of the cooperator runs exactly one chunk
+        self.cooperator = task.Cooperator(terminationPredicateFactory=lambda: lambda: True)
+        self.task = None
+        self.clean_jobs = False
+        self.pending = False
+
+    def broadcast(self, event, chunk, clean_jobs):
+        if self.task is not None:
+            if clean_jobs or not self.clean_jobs:
+                self.task.stop()
+            else:
+                self.pending = True
+                return
+
+        self.pending = False
+        self._start(event, chunk, clean_jobs)
+
+    def _start(self, event, chunk, clean_jobs):
+        start = Interfaces.timestamper.time()
+
+        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _) = \
+            Interfaces.template_registry.get_last_broadcast_args()
+        args = (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
+
+        # The line is encoded only once for all connections
+        frame = Interfaces.template_registry.get_last_notify_frame(clean_jobs)
+        subscriptions = list(Pubsub.iterate_subscribers(event))
+        stats = {'start': start, 'job_id': job_id, 'bytes': len(frame), 'sent': 0, 'fallbacks': 0, 'ticks': 0}
+
+        if chunk <= 0:
+            for _ in self._send(subscriptions, len(subscriptions) or 1, frame, args, stats):
+                pass
+            self._log_stats(stats)
+            return
+
+        self.clean_jobs = clean_jobs
+        self.task = self.cooperator.cooperate(self._send(subscriptions, chunk, frame, args, stats))
+        self.task.whenDone().addCallbacks(self._finished, self._stopped,
+                                          callbackArgs=(event, chunk, stats), errbackArgs=(stats,))
+
+    def _send(self, subscriptions, chunk, frame, args, stats):
+        for i in xrange(0, len(subscriptions), chunk):
+            for subscription in subscriptions[i:i + chunk]:
+                try:
+                    sent = subscription.emit_frame(frame, args)
+                except Exception:
+                    log.exception("Cannot send job %s" % stats['job_id'])
+                    continue
+
+                if sent is None:
+                    continue
+                stats['sent'] += 1
+                if not sent:
+                    stats['fallbacks'] += 1
+
+            stats['ticks'] += 1
+            yield None
+
+    def _log_stats(self, stats):
+        log.info("BROADCASTED to %d connections in %.03f sec (%d bytes per notify, %d encoded separately, %d ticks)" % \
+                 (stats['sent'], (Interfaces.timestamper.time() - stats['start']), stats['bytes'],
+                  stats['fallbacks'], stats['ticks']))
+
+    def _finished(self, _, event, chunk, stats):
+        self.task = None
+        self._log_stats(stats)
+
+        if self.pending:
+            self.pending = False
+            self._start(event, chunk, False)
+
+    def _stopped(self, failure, stats):
+        failure.trap(task.TaskStopped)
+        log.info("Broadcast of job %s interrupted after %d connections in %.03f sec" % \
+                 (stats['job_id'], stats['sent'], Interfaces.timestamper.time() - stats['start']))
+
+
+broadcaster = NotifyBroadcaster()
+
+
 class MiningSubscription(Subscription):
     """This subscription object implements
     logic for broadcasting new jobs to the clients."""
@@ -18,17 +109,25 @@ class MiningSubscription(Subscription):
         """This is called when TemplateRegistry registers
            new block which we have to broadcast clients."""
 
-        start = Interfaces.timestamper.time()
-        clean_jobs = is_new_block
+        # Push new job to subscribed clients
+        broadcaster.broadcast(cls.event, settings.NOTIFY_BROADCAST_CHUNK, is_new_block)
 
-        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _) = \
-            Interfaces.template_registry.get_last_broadcast_args()
+    def emit_frame(self, frame, args):
+        """Write already encoded notify line to the connection.
+        Connections without direct transport access get emit_single(*args).
+        Returns True if the frame was written, False when emit_single
+        was used and None when the connection is closed."""
+        conn = self.connection_ref()
+        if conn is None:
+            return None
 
-        # Push new job to subscribed clients
-        cls.emit(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
+        transport_write = getattr(conn, 'transport_write', None)
+        if transport_write is None:
+            self.emit_single(*args)
+            return False
 
-        cnt = Pubsub.get_subscription_count(cls.event)
-        log.info("BROADCASTED to %d connections in %.03f sec" % (cnt, (Interfaces.timestamper.time() - start)))
+        transport_write(frame)
+        return True
 
     def _finish_after_subscribe(self, result):
         """Send new job to newly subscribed client"""